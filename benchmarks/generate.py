@@ -0,0 +1,90 @@
+import json
+import os
+import shutil
+from os.path import join
+
+# Generates synthetic tmcf projects to benchmark builds against. Every project has:
+# - `functions` function files, each nesting `for` loops `depth` deep over a list of `list_size` items.
+#   Every other file puts its outermost loop in a `generate` block instead, making one file per item.
+# - `json_files` item model files, each a `range_dispatch` with a `for` loop over `dispatch_width` entries
+# - a `global_replace` table of `replace_size` strings, used throughout the function and json files
+def generate_project(root: str, functions: int, json_files: int, depth: int, list_size: int,
+                     dispatch_width: int, replace_size: int):
+    shutil.rmtree(root, ignore_errors=True)
+    os.makedirs(join(root, "data", "bench", "function"))
+    os.makedirs(join(root, "assets", "bench", "items"))
+
+    with open(join(root, "pack.mcmeta"), "w") as f:
+        json.dump({"pack": {"pack_format": 61, "description": "tmcf benchmark"}}, f, indent=4)
+
+    with open(join(root, "tmcf.toml"), "w") as f:
+        f.write(make_config(list_size, replace_size))
+
+    for i in range(functions):
+        with open(join(root, "data", "bench", "function", f"f{i}.mcfunction"), "w") as f:
+            f.write(make_function(i, depth, replace_size))
+
+    for i in range(json_files):
+        with open(join(root, "assets", "bench", "items", f"dispatch_{i}.json"), "w") as f:
+            json.dump(make_dispatch(i, dispatch_width, replace_size), f, indent=4)
+
+
+def make_config(list_size: int, replace_size: int) -> str:
+    items = [f"item_{i}" for i in range(list_size)]
+    config = 'data_out = "./dist"\nassets_out = "./dist"\n\n[variables]\n'
+    config += f"items = {json.dumps(items)}\n"
+    config += "\n[global_replace]\n"
+    for i in range(replace_size):
+        config += f'"{replace_key(i)}" = "replaced:value_{i}"\n'
+    return config
+
+def replace_key(i: int) -> str:
+    return f"RPL{i:05d}"
+
+# The global_replace strings used by file `i`, cycling through the table
+def replace_keys(i: int, replace_size: int) -> list[str]:
+    return [replace_key((i + k) % replace_size) for k in range(min(2, replace_size))]
+
+
+def make_function(i: int, depth: int, replace_size: int) -> str:
+    variables = [f"_v{level}_" for level in range(depth)]
+    keys = " ".join(replace_keys(i, replace_size))
+    lines = [f"# Benchmark function {i}", f"scoreboard objectives add bench_{i} dummy"]
+    for [level, variable] in enumerate(variables):
+        if level == 0 and i % 2 == 1:
+            lines.append(f"#@ generate f{i}_{variable} for {variable} in items")
+        else:
+            lines.append(f"#@ for {variable} in items")
+    if variables:
+        lines.append(f"execute as @a[tag={variables[0]}] run function bench:f{i}/{'/'.join(variables)}")
+        lines.append(f"scoreboard players add {variables[-1]} bench_{i} 1")
+    lines.append(f"say {' '.join(variables)} {keys}".rstrip())
+    lines += ["#@"] * depth
+    lines.append(f"say done {keys}".rstrip())
+    return "\n".join(lines) + "\n"
+
+
+# Numbers are used as loop variables so that the thresholds stay numbers once replaced
+THRESHOLD = 987654
+
+def make_dispatch(i: int, width: int, replace_size: int) -> dict:
+    keys = replace_keys(i, replace_size)
+    entry = {
+        "tmcf": f"for {THRESHOLD} in range {width}",
+        "threshold": THRESHOLD,
+        "model": {
+            "type": "minecraft:model",
+            "model": f"bench:item/dispatch_{i}/entry_{THRESHOLD}",
+            "tints": [{"type": "minecraft:constant", "value": THRESHOLD}]
+        }
+    }
+    if keys:
+        entry["model"]["model"] += "_" + "_".join(keys)
+    return {
+        "model": {
+            "type": "minecraft:range_dispatch",
+            "property": "minecraft:custom_model_data",
+            "entries": [entry],
+            "fallback": {"type": "minecraft:model", "model": f"bench:item/dispatch_{i}/fallback"}
+        }
+    }
@@ -0,0 +1,203 @@
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from os.path import join
+
+from benchmarks.generate import generate_project
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where peak memory isn't measured
+    resource = None
+
+# Benchmarks builds of synthetic projects, to catch changes that make builds slower or use more memory.
+# Run from the repository root with `python -m benchmarks.run`.
+
+# The projects benchmarked by default, each stressing a different part of the build
+SCENARIOS = {
+    "mixed": {"functions": 20, "json_files": 10, "depth": 2, "list_size": 20, "dispatch_width": 100, "replace_size": 20},
+    "many_files": {"functions": 400, "json_files": 200, "depth": 1, "list_size": 5, "dispatch_width": 10, "replace_size": 10},
+    "deep_loops": {"functions": 4, "json_files": 0, "depth": 4, "list_size": 14, "dispatch_width": 0, "replace_size": 0},
+    "wide_dispatch": {"functions": 0, "json_files": 8, "depth": 0, "list_size": 1, "dispatch_width": 3000, "replace_size": 0},
+    "big_replace": {"functions": 20, "json_files": 20, "depth": 2, "list_size": 20, "dispatch_width": 100, "replace_size": 500},
+}
+# Measurements compared against a baseline (where higher is worse), with their units
+COMPARED = {"wall_time": "s", "peak_rss": "MB"}
+
+
+def parse_args(args: list[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.run", description="Benchmarks builds of synthetic tmcf projects.")
+    parser.add_argument("scenarios", nargs="*", metavar="SCENARIO",
+                        help=f"scenarios to run (all by default): {', '.join(SCENARIOS)}")
+    parser.add_argument("--repeat", type=int, default=3, help="builds per scenario - the fastest is kept (default 3)")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="number of processes to build with")
+    parser.add_argument("--cached", action="store_true",
+                        help="keep the template cache between builds, instead of benchmarking builds from scratch")
+    parser.add_argument("--output", help="file to save the results to (default benchmarks/results/<time>.json)")
+    parser.add_argument("--compare", metavar="RESULTS", help="results of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=10,
+                        help="percentage a measurement can get worse by before failing (default 10)")
+    parser.add_argument("--keep", metavar="DIR", help="generate the projects into DIR and keep them")
+
+    custom = parser.add_argument_group("custom scenario", "run a single project with these settings instead")
+    for [name, value] in SCENARIOS["mixed"].items():
+        custom.add_argument(f"--{name.replace('_', '-')}", type=int, metavar="N", help=f"(default {value})")
+
+    parsed = parser.parse_args(args)
+    for name in parsed.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario '{name}' - expected one of {', '.join(SCENARIOS)}")
+    if parsed.repeat < 1:
+        parser.error("--repeat must be at least 1")
+    return parsed
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+
+    settings = {name: getattr(args, name) for name in SCENARIOS["mixed"]}
+    if any(value is not None for value in settings.values()):
+        scenarios = {"custom": {name: SCENARIOS["mixed"][name] if value is None else value for [name, value] in settings.items()}}
+    else:
+        scenarios = {name: SCENARIOS[name] for name in args.scenarios or SCENARIOS}
+
+    root = args.keep or tempfile.mkdtemp(prefix="tmcf-bench-")
+    try:
+        results = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "jobs": args.jobs,
+            "cached": args.cached,
+            "scenarios": {}
+        }
+        for [name, params] in scenarios.items():
+            project = join(root, name)
+            generate_project(project, **params)
+            result = run_scenario(project, args.repeat, args.jobs, args.cached)
+            results["scenarios"][name] = {"params": params, **result}
+            print_result(name, result)
+    finally:
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+    output = args.output or join("benchmarks", "results", time.strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Saved results to {output}")
+
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+        if not compare(baseline, results, args.threshold):
+            sys.exit(1)
+
+
+# Builds a project `repeat` times, each in a fresh process so that peak memory is measured per build
+def run_scenario(project: str, repeat: int, jobs: int, cached: bool) -> dict:
+    context = multiprocessing.get_context("spawn")
+    runs = []
+    for _ in range(repeat):
+        if not cached:
+            shutil.rmtree(join(project, ".tmcf"), ignore_errors=True)
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=build_once, args=(project, jobs, sender))
+        process.start()
+        sender.close()
+        try:
+            runs.append(receiver.recv())
+        except EOFError:
+            sys.exit(f"Building {project} failed")
+        process.join()
+
+    wall_time = min(run["wall_time"] for run in runs)
+    peak_rss = max(run["peak_rss"] for run in runs) if runs[0]["peak_rss"] is not None else None
+    files, size = output_size(join(project, "dist", "tmcf_build"))
+    return {
+        "wall_time": wall_time,
+        "wall_times": [run["wall_time"] for run in runs],
+        "peak_rss": peak_rss,
+        "files": files,
+        "bytes": size,
+        "files_per_second": files / wall_time,
+        "bytes_per_second": size / wall_time,
+    }
+
+# Builds the project in the current process, sending back the build's wall time and the process's peak memory in MB
+def build_once(project: str, jobs: int, sender):
+    from tmcf import main
+    from tmcf.command import build
+
+    os.chdir(project)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        config = main.validate_config()
+        started = time.perf_counter()
+        build.build_pack(config, jobs=jobs)
+        wall_time = time.perf_counter() - started
+
+    peak_rss = None
+    if resource:
+        # Kilobytes on Linux, bytes on macOS
+        unit = 1 if sys.platform == "darwin" else 1024
+        peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        peak_rss = peak * unit / (1 << 20)
+    sender.send({"wall_time": wall_time, "peak_rss": peak_rss})
+
+# Counts the files built and their total size
+def output_size(root: str) -> (int, int):
+    files = 0
+    size = 0
+    for [directory, _, names] in os.walk(root):
+        for name in names:
+            if name != ".tmcf_manifest.json":
+                files += 1
+                size += os.path.getsize(join(directory, name))
+    return files, size
+
+
+def print_result(name: str, result: dict):
+    rss = "n/a" if result["peak_rss"] is None else f"{result['peak_rss']:.1f} MB"
+    print(f"{name:>16}: {result['wall_time'] * 1000:9.1f} ms, peak {rss}, "
+          f"{result['files_per_second']:,.0f} files/s, {result['bytes_per_second'] / (1 << 20):,.1f} MB/s "
+          f"({result['files']} files, {result['bytes'] / (1 << 20):.1f} MB)")
+
+# Prints how each scenario changed since `baseline`, returning False if anything got worse by more than `threshold` percent
+def compare(baseline: dict, results: dict, threshold: float) -> bool:
+    passed = True
+    print(f"Compared with {baseline['time']}:")
+    for [name, result] in results["scenarios"].items():
+        before = baseline["scenarios"].get(name)
+        if before is None:
+            print(f"{name:>16}: not in baseline")
+            continue
+        if before["params"] != result["params"]:
+            print(f"{name:>16}: settings differ from baseline, skipped")
+            continue
+
+        changes = []
+        for [measurement, unit] in COMPARED.items():
+            if before[measurement] is None or result[measurement] is None:
+                continue
+            change = (result[measurement] - before[measurement]) / before[measurement] * 100
+            regressed = change > threshold
+            passed = passed and not regressed
+            changes.append(f"{measurement} {before[measurement]:.3f} -> {result[measurement]:.3f} {unit} ({change:+.1f}%)"
+                           + (" REGRESSION" if regressed else ""))
+        print(f"{name:>16}: {', '.join(changes)}")
+
+    if not passed:
+        print(f"Failed: some measurements got more than {threshold:g}% worse")
+    return passed
+
+
+if __name__ == "__main__":
+    main()
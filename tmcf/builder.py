@@ -0,0 +1,153 @@
+import os
+import threading
+from contextlib import contextmanager
+
+from tmcf import utils
+from tmcf.command import build
+from tmcf.config import ConfigType
+from tmcf.index import ProjectIndex
+from tmcf.logging import l
+from tmcf.main import check_project, validate_config
+from tmcf.manifest import Manifest, config_hash
+from tmcf.utils import hash_file, project_path
+
+# The build keeps what it's building with in module globals, so builders take turns with it
+lock = threading.RLock()
+
+# Builds a project from inside another Python process (like an editor plugin, test runner or deploy script),
+# without going through the command line. The config is read once and kept, along with the manifest of the
+# last build, so rebuilding a single file only builds that file. Each builder keeps its own config, templates and
+# index of the project, and builders (on any thread) take turns building, so they don't get in each other's way.
+# Errors that would stop the command line raise `tmcf.logging.FatalError` instead.
+#
+#     builder = Builder("path/to/project")
+#     builder.build_all()
+#     builder.build_file("data/ns/function/tick.mcfunction")
+#     print(builder.render_function("data/ns/function/load.mcfunction"))
+class Builder:
+    root: str
+    jobs: int
+    # Whether to minify the output, even if the config doesn't ask for it
+    release: bool
+    config: ConfigType
+    # Every source in the last build, with its hash and outputs
+    manifest: Manifest | None
+    # Compiled function templates, by the hash of their source, and every file in the project
+    templates: dict[str, list]
+    project_index: ProjectIndex | None
+
+    def __init__(self, root: str = ".", jobs: int = 1, release: bool = False):
+        self.root = os.path.abspath(root)
+        self.jobs = jobs
+        self.release = release
+        self.config = None
+        self.manifest = None
+        self.templates = {}
+        self.project_index = None
+        with self.project():
+            self.load_config()
+
+    # Runs the block with the build set up for this project (resolving its paths against `root` rather than
+    # changing the working directory), raising errors instead of exiting. Whatever the build was set up with
+    # before is put back afterwards.
+    @contextmanager
+    def project(self):
+        with lock:
+            previous = (utils.project_root, build.config, build.templates, build.project_index)
+            utils.project_root = self.root
+            build.templates = self.templates
+            build.project_index = self.project_index
+            try:
+                with l.raising():
+                    if self.config:
+                        build.use_config(self.config)
+                    yield
+            finally:
+                # The build replaces the index if it had to make a new one
+                self.project_index = build.project_index
+                utils.project_root, build.config, build.templates, build.project_index = previous
+
+    def load_config(self):
+        check_project()
+        self.config = validate_config(self.release)
+        build.use_config(self.config)
+        self.manifest = None
+
+    # Builds everything that has changed since the last build, or everything if the config has changed
+    def build_all(self) -> Manifest:
+        with self.project():
+            self.manifest = build.build_pack(self.config, incremental=True, jobs=self.jobs)
+            return self.manifest
+
+    # Rebuilds a single file of the project (given relative to the project), or deletes its outputs if it
+    # no longer exists. Returns the outputs it now has.
+    def build_file(self, path: str) -> list[str]:
+        with self.project():
+            source = self.source_path(path)
+            name = os.path.normpath(source)
+
+            if name == "tmcf.toml":
+                self.load_config()
+                self.manifest = build.build_pack(self.config, incremental=True, jobs=self.jobs)
+                return []
+            if name in [os.path.normpath(source["path"]) for source in self.config["variable_files"].values()]:
+                # Rebuilds the sources using the variable
+                self.manifest = build.build_pack(self.config, incremental=True, jobs=self.jobs)
+                return []
+            if self.config["zip"]:
+                # Zips can't be updated in place
+                self.manifest = build.build_pack(self.config, jobs=self.jobs)
+                return self.manifest.sources.get(source, {"outputs": []})["outputs"]
+
+            manifest = self.last_build()
+            if name == "pack.mcmeta":
+                build.copy_pack_meta()
+                return [os.path.join(self.config["data_out"], name), os.path.join(self.config["assets_out"], name)]
+            if os.path.isfile(project_path(source)):
+                build.update_pack(manifest, [source], [], self.jobs)
+            else:
+                build.update_pack(manifest, [], [source], self.jobs)
+            return manifest.sources.get(source, {"outputs": []})["outputs"]
+
+    # Returns the main output of a function file (given relative to the project) without writing anything,
+    # or "" if it would be left out of the build for being empty. Files made by `generate` blocks aren't rendered.
+    def render_function(self, path: str) -> str:
+        with self.project():
+            source = self.source_path(path)
+            if build.source_builder(source) is not build.build_function:
+                l.fatal(f"'{path}' is not a function file in the project's data folder")
+            if not os.path.isfile(project_path(source)):
+                l.fatal(f"Failed to find function file '{path}'")
+
+            digest = hash_file(source)
+            cached = digest in self.templates
+            try:
+                return build.render_function(source, digest)
+            finally:
+                # Only templates of built files are kept, so rendering edit after edit doesn't pile them up
+                if not cached:
+                    self.templates.pop(digest, None)
+
+    # Returns the manifest of the last build, first rebuilding whatever the config has changed since then
+    # (or everything, if there isn't a usable one)
+    def last_build(self) -> Manifest:
+        if self.manifest is None:
+            manifest = Manifest.load(self.config["data_out"])
+            usable = manifest is not None and manifest.config_hash == config_hash(self.config)
+            if usable:
+                manifest.update_config(self.config)
+            # Sources that use changed variables or `global_replace` strings are rebuilt by an incremental build
+            if usable and not manifest.invalid:
+                self.manifest = manifest
+                if not self.templates:
+                    self.templates.update(build.template.load_cache())
+            else:
+                self.manifest = build.build_pack(self.config, incremental=True, jobs=self.jobs)
+        return self.manifest
+
+    # Returns a path within the project the way the build refers to it (like `./data/ns/function/tick.mcfunction`)
+    def source_path(self, path: str) -> str:
+        relative = os.path.relpath(os.path.join(self.root, path), self.root)
+        if relative == os.pardir or relative.startswith(os.pardir + os.sep):
+            l.fatal(f"'{path}' is not inside the project")
+        return os.path.join(".", relative)
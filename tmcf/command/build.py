@@ -1,92 +1,714 @@
-import glob
+import itertools
 import json
 import os
 import shutil
-from typing import Iterable
-
-from tmcf.main import ConfigType
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from typing import Iterator
+
+from tmcf import template, profile, index, variable_files, staging, utils
+from tmcf.dispatch import Dispatch, split_dispatch, item_key, MACRO_KEY
+from tmcf.command import plan
+from tmcf.config import ConfigType
+from tmcf.index import ProjectIndex
 from tmcf.logging import l, function_ref, generic_ref
-from tmcf.utils import write, Consumable
+from tmcf.manifest import Manifest, config_hash
+from tmcf.minify import Minifier, compact_json
+from tmcf.replace import substitution, Substitution, Plan
+from tmcf.template import Block, Text
+from tmcf.utils import write, hash_file, OutputFile, copy_file, is_copy_current, Archive, SpooledArchive, archives, archive_for, LoopItems
+from tmcf.utils import made_dirs, start_writes, drain_writes, finish_writes, project_path
 
 config: ConfigType = None
-
-def build_pack(conf: ConfigType):
-    global config
-    config = conf
+# The `global_replace` table for each kind of file ("function" or "json"), compiled along with its values
+replace_tables: dict[str, tuple[Substitution, tuple]] = {}
+# Output files written while building the current source file
+written: list[str] = []
+# Variables read and `global_replace` strings found while building the current source file, so that
+# incremental builds know which config changes affect it
+variables_read: set[str] = set()
+replaced: set[str] = set()
+# Whether to show why each source file is rebuilt
+explain = False
+# In release builds, how many bytes the current source file's outputs would have been and how many they are minified
+minified_sizes: list[int] = [0, 0]
+# Compiled function templates, by the hash of their source
+templates: dict[str, list] = {}
+# Every file in the project, kept up to date between builds
+project_index: ProjectIndex | None = None
+# Worker processes kept running between parallel builds inside `keep_workers` (like the rebuilds of `tmcf watch`)
+pool: ProcessPoolExecutor | None = None
+keeping_workers = False
+# How many parallel builds there have been, so that kept workers know when they're given a new build's work.
+# In a worker, `worker_build` is the build it was last set up for.
+parallel_builds = 0
+worker_build = 0
+# How many items of a loop containing only text are rendered into each chunk
+RENDER_BATCH = 256
+# Loops inside other loops that produce at most this much text are only expanded once per file
+EXPAND_LIMIT = 1 << 20
+# Loops that have been expanded while rendering the current file, by their text node
+expanded: dict[Text, Plan] = {}
+# Json objects repeated at least this many times are compiled, rather than replaced as text and parsed again
+COMPILE_JSON_MIN = 32
+# How many copied files are listed after a build
+COPY_LIST_LIMIT = 10
+
+def build_pack(conf: ConfigType, incremental: bool = False, jobs: int = 1) -> Manifest:
+    global project_index, config
+    use_config(conf)
 
     l.success("Building!")
 
+    with profile.phase("indexing"):
+        if project_index is None or project_index.root != os.path.abspath(project_path(".")):
+            project_index = ProjectIndex.load()
+        project_index.scan()
+        sources = project_index.files("function") + project_index.files("json")
+        # Everything else (structures, textures, sounds...) is copied as it is
+        others = project_index.files("passthrough")
+
     out_dp = config["data_out"]
     out_rp = config["assets_out"]
 
-    # Delete previous build
-    shutil.rmtree(out_dp, ignore_errors=True)
-    shutil.rmtree(out_rp, ignore_errors=True)
-
-    # Create output directories
-    os.makedirs(out_dp, exist_ok=True)
-    os.makedirs(out_rp, exist_ok=True)
-
-    shutil.copy("./pack.mcmeta", out_dp)
-    shutil.copy("./pack.mcmeta", out_rp)
-
-    # Process functions
-    functions = glob.glob("./data/**/*.mcfunction", recursive=True)
-    for function_path in functions:
-        with open(function_path, "r") as f:
-            output = ""
-            lines = Consumable(f.readlines())
-
-        # Process the lines of the function
-        while lines.is_consumable():
-            output += handle_line(lines, function_path) + "\n"
-
-        # Only write to output if function has contents
-        if output.strip():
-            # Handle global replacements
-            for replacee, replacement in config["global_replace"]["function"].items():
-                output = output.replace(replacee, replacement)
-
-            write(os.path.join(out_dp, function_path[2:]), output)
-
-    # Process json files
-    json_files = glob.glob("./data/**/*.json", recursive=True)
-    for json_path in json_files:
-        with open(json_path, "r") as f:
-            j = json.load(f)
-
-        process_json(j, json_path)
-        write(os.path.join(out_dp, json_path[2:]), json.dumps(j, indent = 2))
+    # Reuse the previous build if its manifest is usable. Changed variables and `global_replace` strings
+    # only rebuild the sources that use them, while any other change to the config rebuilds everything.
+    settings_hash = config_hash(config)
+    manifest = Manifest.load(out_dp) if incremental and not config["zip"] else None
+    reason = "no previous build" if incremental and not config["zip"] else "full build"
+    if manifest and manifest.config_hash != settings_hash:
+        l.warn("Build settings (in `tmcf.toml` or `--release`) have changed since the last build, rebuilding everything.")
+        manifest = None
+        reason = "build settings changed"
+
+    # Full builds with `staged = true` are built beside the previous build, which stays in place until
+    # the new one is finished and swapped in for it
+    reused = manifest is not None
+    staged = not reused and config["staged"]
+    outs = list(dict.fromkeys(os.path.normpath(out) for out in [out_dp, out_rp]))
+    if not reused:
+        manifest = Manifest(settings_hash, rebuild_reason=reason)
+    manifest.update_config(config)
+
+    if config["limits"]:
+        # Stop before the previous build is touched if this one would be too big. Sources that won't
+        # be rebuilt keep the estimates recorded in the manifest, so only the rest are planned.
+        with profile.phase("planning"):
+            plan.check_limits(plan.plan_pack(sources, manifest), config["limits"])
+
+    if not reused:
+        with profile.phase("cleanup"):
+            if staged:
+                for out in outs:
+                    staging.prepare(out)
+                config = {**conf, "data_out": staging.staging_path(out_dp), "assets_out": staging.staging_path(out_rp)}
+            else:
+                # Delete previous build, whether it was built into folders or zips
+                shutil.rmtree(project_path(out_dp), ignore_errors=True)
+                shutil.rmtree(project_path(out_rp), ignore_errors=True)
+                for path in [out_dp + ".zip", out_rp + ".zip"]:
+                    if os.path.exists(project_path(path)):
+                        os.remove(project_path(path))
+            made_dirs.clear()
 
+    try:
+        with pack_archives():
+            # Create output directories
+            if not archives:
+                os.makedirs(project_path(config["data_out"]), exist_ok=True)
+                os.makedirs(project_path(config["assets_out"]), exist_ok=True)
+
+            copy_pack_meta()
+            if not templates:
+                templates.update(template.load_cache())
+            manifest.retain(sources + others)
+
+            with profile.phase("building"):
+                built = build_sources(sources, manifest, jobs)
+            with profile.phase("copying"):
+                copied = copy_files(others, manifest)
+            with profile.phase("finishing"):
+                deleted = manifest.delete_stale([config["data_out"], config["assets_out"]])
+                if staged:
+                    manifest.relocate({config["data_out"]: out_dp, config["assets_out"]: out_rp})
+                # Zips are always built whole, so there's nothing for a later build to reuse
+                if not archives:
+                    manifest.save(config["data_out"])
+                save_templates(manifest)
+                project_index.save()
+    finally:
+        config = conf
+
+    if staged:
+        with profile.phase("swapping"):
+            for out in outs:
+                staging.swap(out, config["zip"])
+            made_dirs.clear()
+        staging.delete_old(outs)
+
+    if incremental:
+        l.print(f"Rebuilt {built} source file(s), deleted {deleted} stale output(s).")
+    report_copies(copied, len(others))
     l.success("Successfully built!")
+    return manifest
+
 
+# Sets the config everything is built with
+def use_config(conf: ConfigType):
+    global config
+    config = conf
+    # Variables from files are loaded again, in case the files have changed
+    variable_files.loaded.clear()
+    replace_tables.clear()
+    for [kind, table] in config["global_replace"].items():
+        replace_tables[kind] = (substitution(tuple(table)), tuple(table.values()))
+
+
+# Rebuilds only the given changed and removed sources on top of an existing build, for
+# long-running builds (like `tmcf watch`) that already know what has changed
+def update_pack(manifest: Manifest, changed: list[str], removed: list[str], jobs: int = 1) -> int:
+    for path in removed:
+        manifest.forget(path)
+
+    built = build_sources(sorted(changed), manifest, jobs)
+    others = [path for path in sorted(changed) if not source_builder(path) and os.path.normpath(path).startswith(("data" + os.sep, "assets" + os.sep))]
+    copied = copy_files(others, manifest)
+    manifest.delete_stale([config["data_out"], config["assets_out"]])
+    manifest.save(config["data_out"])
+    save_templates(manifest)
+    report_copies(copied, len(others))
+    return built + len(copied)
+
+
+# Saves the compiled templates of the sources that still exist, for the next build
+def save_templates(manifest: Manifest):
+    current = {source["hash"] for source in manifest.sources.values()}
+    for digest in [digest for digest in templates if digest not in current]:
+        del templates[digest]
+    template.save_cache(templates)
+
+
+def copy_pack_meta():
+    copy_file("./pack.mcmeta", os.path.join(config["data_out"], "pack.mcmeta"))
+    copy_file("./pack.mcmeta", os.path.join(config["assets_out"], "pack.mcmeta"))
+
+
+# Builds the packs into zips instead of folders for the duration of a build, if the config asks for it.
+# Files are streamed into the zips as they're written, and the zips are finished once the build has, or
+# deleted if it fails.
+@contextmanager
+def pack_archives():
+    if config["zip"]:
+        # Both packs go in the same zip when they're built into the same folder
+        roots = dict.fromkeys(os.path.normpath(root) for root in [config["data_out"], config["assets_out"]])
+        archives.extend(Archive(root, root + ".zip", config["compression_level"]) for root in roots)
+    try:
+        yield
+        for archive in archives:
+            with profile.phase("zipping"):
+                archive.close()
+            l.print(f"Wrote {staging.published_path(archive.path)}")
+    except BaseException:
+        for archive in archives:
+            archive.abort()
+        raise
+    finally:
+        archives.clear()
+
+
+# Returns the function used to build a source file, or None if it's copied as it is
+def source_builder(path: str):
+    return {"function": build_function, "json": build_json}.get(index.kind(path))
+
+
+# Returns the pack a source file is built into
+def output_root(path: str) -> str:
+    return config["assets_out"] if os.path.normpath(path).startswith("assets" + os.sep) else config["data_out"]
+
+
+# Builds every source that has changed since it was recorded in the manifest, returning how many were built
+def build_sources(paths: list[str], manifest: Manifest, jobs: int = 1) -> int:
+    digests = {}
+    reasons = {}
+    for path in paths:
+        if source_builder(path):
+            digest = hash_file(path)
+            reason = manifest.rebuild_reason_for(path, digest)
+            if reason is not None:
+                digests[path] = digest
+                reasons[path] = reason
+    todo = list(digests)
+    if explain:
+        explain_rebuilds(reasons)
+
+    if jobs > 1 and len(todo) > 1:
+        outputs, errors = build_in_parallel([(path, digests[path]) for path in todo], jobs)
+    else:
+        # Files are written in the background while the next ones are built
+        start_writes()
+        try:
+            outputs = [build_source(path, digests[path]) for path in todo]
+        finally:
+            errors = finish_writes()
+    check_writes(errors)
+
+    savings = {}
+    for [path, [written_outputs, dependencies, sizes]] in zip(todo, outputs):
+        manifest.update(path, digests[path], written_outputs, dependencies)
+        namespace = "/".join(os.path.normpath(path).split(os.sep)[:2])
+        totals = savings.setdefault(namespace, [0, 0])
+        totals[0] += sizes[0]
+        totals[1] += sizes[1]
+    if config["release"] and todo:
+        report_savings(savings)
+    return len(todo)
+
+
+# Reports how much smaller minifying made the files built in each namespace
+def report_savings(savings: dict[str, list[int]]):
+    l.print("Minified for release:")
+    for [namespace, [before, after]] in sorted(savings.items()):
+        saved = (before - after) / before * 100 if before else 0
+        l.print(f"  {namespace}: {before / 1024:,.1f} KB -> {after / 1024:,.1f} KB ({saved:.1f}% smaller)")
+
+
+# Lists the sources about to be rebuilt, grouped by why they are being rebuilt
+def explain_rebuilds(reasons: dict[str, str]):
+    if not reasons:
+        l.print("Nothing to rebuild.")
+        return
+    groups = {}
+    for [path, reason] in reasons.items():
+        groups.setdefault(reason, []).append(path)
+    l.print(f"Rebuilding {len(reasons)} source file(s):")
+    for [reason, paths] in groups.items():
+        l.print(f"  {reason}:", l.CYAN)
+        for path in paths:
+            l.print(f"    {os.path.normpath(path)}")
+
+
+# Copies files that aren't built into the build, skipping those whose copy already has the same size and
+# modification time. Returns the paths that were copied.
+def copy_files(paths: list[str], manifest: Manifest) -> list[str]:
+    copied = []
+    for path in paths:
+        try:
+            stat = os.stat(project_path(path))
+        except FileNotFoundError:
+            continue
+        out_path = os.path.normpath(os.path.join(output_root(path), path[2:]))
+        if not is_copy_current(stat, out_path):
+            with profile.timer("write"):
+                copy_file(path, out_path)
+            copied.append(path)
+            if profile.active:
+                profile.add("bytes", stat.st_size)
+                profile.add("files", 1)
+        manifest.update(path, None, [out_path])
+    return copied
+
+
+# Reports every write that failed, stopping the build if any did
+def check_writes(errors: list[tuple[str, str, OSError]]):
+    if not errors:
+        return
+    for [path, ref, error] in errors:
+        l.error(f"Failed to write '{path}': {error.strerror or error}", ref)
+    l.fatal(f"Failed to write {len(errors)} file(s)")
 
-def handle_line(lines: Consumable, path: str):
-    line = lines.consume().strip()
 
-    if not line.startswith("#@"): return line
+def report_copies(copied: list[str], total: int):
+    if not copied:
+        return
+    size = sum(os.path.getsize(project_path(path)) for path in copied)
+    l.print(f"Copied {len(copied)} other file(s) ({size / (1 << 20):.1f} MB), {total - len(copied)} already up to date:")
+    for path in copied[:COPY_LIST_LIMIT]:
+        l.print(f"  {os.path.normpath(path)}")
+    if len(copied) > COPY_LIST_LIMIT:
+        l.print(f"  ...and {len(copied) - COPY_LIST_LIMIT} more")
+
+
+# Builds a single source file, returning the outputs it wrote, the config values it depends on, and
+# the size of its outputs before and after minifying (in release builds)
+def build_source(path: str, digest: str) -> tuple[list[str], dict[str, list[str]], list[int]]:
+    written.clear()
+    variables_read.clear()
+    replaced.clear()
+    minified_sizes[:] = [0, 0]
+    builder = source_builder(path)
+    profile.begin_source(path, "functions" if builder is build_function else "json")
+    builder(path, digest)
+    profile.end_source(len(written))
+    return written.copy(), {"variables": sorted(variables_read), "global_replace": sorted(replaced)}, minified_sizes.copy()
+
+
+def init_worker(root: str, conf: ConfigType, profile_start: float | None, raise_errors: bool, spool_folder: str | None):
+    utils.project_root = root
+    use_config(conf)
+    l.raise_errors = raise_errors
+    if profile_start is not None:
+        profile.enable(profile_start)
+    else:
+        profile.active = False
+    # Workers already write alongside each other, so they write their files as they build them
+    start_writes(0)
+    # Workers can't share the main process's zips, so they write their files into `spool_folder` and hand them back
+    archives.clear()
+    if spool_folder is not None:
+        archives.extend(SpooledArchive(root, spool_folder) for root in dict.fromkeys(os.path.normpath(root) for root in [config["data_out"], config["assets_out"]]))
+
+
+# Builds a source in a worker process, given its compiled template if there is one.
+# Returns the outputs and dependencies, the template if the worker had to compile it, the outputs written into
+# a zip (each with the temporary file holding it), the profile of the source if profiling, and the writes that failed
+# Kept workers are also given the build's number and `init_worker` arguments, to set up again for each build.
+def build_in_worker(task: tuple[str, str, list, tuple | None]) -> tuple[tuple[list[str], dict, list[int]], list, list[tuple[str, str]], list[dict], list]:
+    global worker_build
+    path, digest, compiled, setup = task
+    if setup is not None and setup[0] != worker_build:
+        init_worker(*setup[1:])
+        worker_build = setup[0]
+    if compiled is not None:
+        templates[digest] = compiled
+    outputs = build_source(path, digest)
+
+    archived = []
+    for archive in archives:
+        archived += archive.take()
+    return outputs, templates.get(digest) if compiled is None else None, archived, profile.take(), drain_writes()
+
+
+# Keeps the worker processes of parallel builds running from one build to the next until the end of the
+# `with` block, rather than starting them again for each build
+@contextmanager
+def keep_workers():
+    global keeping_workers, pool
+    keeping_workers = True
+    try:
+        yield
+    finally:
+        keeping_workers = False
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+            pool = None
+
+
+# Returns the outputs and dependencies of each source, and the writes that failed
+def build_in_parallel(sources: list[tuple[str, str]], jobs: int) -> tuple[list[tuple[list[str], dict, list[int]]], list]:
+    global pool, parallel_builds
+    # Zip entries written by the workers are kept here until they're streamed into the zips
+    spool_folder = tempfile.mkdtemp(prefix="tmcf-") if archives else None
+    setup = (utils.project_root, config, profile.start if profile.active else None, l.raise_errors, spool_folder)
+    if keeping_workers:
+        # The config goes along with the tasks (once per chunk), as it can change between builds
+        if pool is None:
+            pool = ProcessPoolExecutor(max_workers=jobs)
+        executor = pool
+        parallel_builds += 1
+        setup = (parallel_builds, *setup)
+    else:
+        # Each worker is given the config once when it starts, then builds (and writes) whole source files
+        executor = ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=setup)
+        setup = None
+    tasks = [(path, digest, templates.get(digest), setup) for [path, digest] in sources]
+    outputs = []
+    errors = []
+    try:
+        # Results come back in the order of the sources, as soon as each one and those before it are built
+        results = executor.map(build_in_worker, tasks, chunksize=max(1, len(tasks) // (jobs * 4)))
+        for [[path, digest], [written_outputs, compiled, archived, records, failed]] in zip(sources, results):
+            if compiled is not None:
+                templates[digest] = compiled
+            outputs.append(written_outputs)
+            profile.sources.extend(records)
+            errors += failed
+            # Streamed in the same order as a serial build, so the zips are the same and the last writer of each file wins
+            for [output, spooled] in archived:
+                archive_for(output).add_file(output, spooled, remove=True)
+    except BaseException:
+        # A worker hit a fatal error (which it has already reported), so don't start anything else.
+        # Kept workers are stopped too, once they've finished what they're writing, and started again by the next build.
+        executor.shutdown(cancel_futures=True)
+        pool = None
+        raise
+    finally:
+        if spool_folder is not None:
+            shutil.rmtree(spool_folder, ignore_errors=True)
+    if executor is not pool:
+        executor.shutdown()
+
+    # Nothing has been written into the zips except in the order above, so that's all that matters
+    if archives:
+        return outputs, errors
+
+    # When several sources write the same file, a serial build leaves the last one's version.
+    # Rebuild the last writer of each such file here so the output is identical regardless of scheduling
+    writers: dict[str, list[int]] = {}
+    for [i, [written_outputs, _, _]] in enumerate(outputs):
+        for output in written_outputs:
+            writers.setdefault(output, []).append(i)
+    start_writes()
+    try:
+        for i in sorted({indices[-1] for indices in writers.values() if len(indices) > 1}):
+            outputs[i] = build_source(*sources[i])
+    finally:
+        errors += finish_writes()
+
+    return outputs, errors
+
+
+# Writes a file into the build, recording it as an output of the current source file
+def write_output(path: str, contents: str, ref: str = None):
+    path = os.path.normpath(path)
+    written.append(path)
+    write(path, contents, ref)
+
+
+def build_function(function_path: str, digest: str):
+    nodes = compiled_function(function_path, digest)
+    expanded.clear()
+
+    for block in template.generate_blocks(nodes):
+        generate_functions(block, function_path)
+
+    # Only write to output if function has contents
+    out_path = os.path.join(config["data_out"], function_path[2:])
+    # Strings replaced across lines can only be found in the whole output
+    spans_lines = any("\n" in key for key in config["global_replace"]["function"])
+    with open_output(out_path, lambda s: global_replace(s, "function"), skip_blank=True, ref=generic_ref(function_path), minify=True, spans_lines=spans_lines) as output:
+        for chunk in render_nodes(nodes, function_path):
+            output.write(chunk)
+        if nodes:
+            output.write("\n")
+
+
+# Renders the main output of a function file without writing anything, or returns "" if it wouldn't be written
+def render_function(function_path: str, digest: str) -> str:
+    nodes = compiled_function(function_path, digest)
+    expanded.clear()
+    text = "".join(render_nodes(nodes, function_path)) + ("\n" if nodes else "")
+    if not text.strip():
+        return ""
+    text = global_replace(text, "function")
+    if config["release"]:
+        minifier = Minifier()
+        text = minifier.feed(text) + minifier.finish()
+    return text
+
+
+def build_json(json_path: str, digest: str):
+    with profile.timer("parse"), open(project_path(json_path), "r") as f:
+        j = json.load(f)
+
+    process_json(j, json_path)
+    write_output(os.path.join(output_root(json_path), json_path[2:]), global_replace(dump_json(j), "json"), generic_ref(json_path))
+
+
+# Returns the text of a json file: indented in development builds, and compact in release builds
+def dump_json(j) -> str:
+    if not config["release"]:
+        return json.dumps(j, indent = 2)
+    text = compact_json(j)
+    minified_sizes[0] += len(json.dumps(j, indent = 2).encode())
+    minified_sizes[1] += len(text.encode())
+    return text
+
+
+# Opens a file in the build to be written in chunks, recording it as an output of the current source file if it gets created.
+# `minify` strips function output in release builds.
+@contextmanager
+def open_output(path: str, transform = None, skip_blank: bool = False, ref: str = None, minify: bool = False, spans_lines: bool = False):
+    minifier = Minifier() if minify and config["release"] else None
+    with OutputFile(path, transform, skip_blank, ref, minifier, spans_lines) as output:
+        yield output
+    if output.created:
+        written.append(output.path)
+    if minifier:
+        minified_sizes[0] += minifier.before
+        minified_sizes[1] += minifier.after
+
+
+# Returns the compiled template of a function file, compiling it if it isn't cached
+def compiled_function(path: str, digest: str) -> list:
+    if digest not in templates:
+        with profile.timer("parse"), open(project_path(path), "r") as f:
+            templates[digest] = template.compile_function(f.readlines(), path)
+    return templates[digest]
+
+
+# Renders template nodes as a stream of text chunks. `values` holds the values of the variables in
+# scope, innermost first, matching the names each run of text was split on.
+def render_nodes(nodes: list, path: str, values: tuple = ()) -> Iterator[str]:
+    for [i, node] in enumerate(nodes):
+        if i:
+            yield "\n"
+        if isinstance(node, Text):
+            with profile.timer("replace"):
+                text = node.plan.render(values, config["chained_replace"])
+            yield text
+        else:
+            chunks = render_block(node, path, values)
+            if profile.active:
+                chunks = profile.block(chunks, block_name(node))
+            yield from without_first_char(chunks) if node.strip_first else chunks
 
-    tokens = line.strip().split(" ")
 
-    if not len(tokens) > 1:
-        l.fatal(f"Missing token after tmcf comment - expected 'for', 'generate', or 'using'", function_ref(path, lines.index))
+def render_block(block: Block, path: str, values: tuple) -> Iterator[str]:
+    ref = function_ref(path, block.line_no)
 
-    match tokens[1]:
+    match block.kind:
         case "for":
-            content, *_ = function_for_loop(tokens, lines, path)
-            return "\n".join(content)
-        case "generate":
-            file_generations(tokens, lines, path)
-            return ""
+            variables, items = parse_for_loop(block.tokens[1:], ref)
+            if profile.active:
+                profile.expansions(block_name(block), len(items))
+            if len(block.children) == 1 and isinstance(block.children[0], Text):
+                yield from render_text_loop(block.children[0], variables, items, values, ref)
+                return
+
+            for [i, item] in enumerate(items):
+                check_replacements(variables, item, ref)
+                if i:
+                    yield "\n"
+                yield from render_nodes(block.children, path, tuple(item) + values)
         case "using":
-            return using_variable(tokens[1:], lines, path)
-        case _ as t:
-            l.fatal(f"Unexpected token '{t}' in tmcf comment - expected 'for', 'generate', or 'using'", function_ref(path, lines.index))
+            variables, replacements = parse_using(block.tokens[1:], ref)
+            if any([isinstance(replacement, dict) or isinstance(replacement, list) for replacement in replacements]):
+                l.fatal("Variable used in 'using' block must be a string or number.", ref)
+            check_replacements(variables, replacements, ref)
+            if profile.active:
+                profile.expansions(block_name(block), 1)
+            yield from render_nodes(block.children, path, tuple(replacements) + values)
+        case "generate":
+            # Generated files are written separately by `generate_functions`, and leave an empty line behind
+            return
+
+
+# Renders a for loop containing nothing but text, many items per chunk
+def render_text_loop(text: Text, variables: list[str], items: list | LoopItems, values: tuple, ref: str) -> Iterator[str]:
+    chained = config["chained_replace"]
+
+    if not chained and values and len(text.plan.text) * len(items) <= EXPAND_LIMIT:
+        # A loop inside another loop renders the same items every time, so expand it once and
+        # then only fill in the enclosing loops' values
+        with profile.timer("replace"):
+            if text not in expanded:
+                for item in items:
+                    check_replacements(variables, item, ref)
+                expanded[text] = text.plan.expand(items, len(variables))
+            rendered = expanded[text].render(values) if items else None
+        if rendered is not None:
+            yield rendered
+        return
+
+    # The enclosing loops' values are the same for every item, so fill them in first
+    plan = text.plan if chained else text.plan.bind(values, len(variables))
+
+    items = iter(items)
+    separator = ""
+    while True:
+        # Timed a batch at a time, so that timing each item doesn't slow it down
+        with profile.timer("replace"):
+            batch = []
+            for item in itertools.islice(items, RENDER_BATCH):
+                check_replacements(variables, item, ref)
+                batch.append(plan.render(tuple(item) + values if chained else item, chained))
+        if not batch:
+            return
+        yield separator + "\n".join(batch)
+        separator = "\n"
+
+
+def without_first_char(chunks: Iterator[str]) -> Iterator[str]:
+    chunks = iter(chunks)
+    for chunk in chunks:
+        if chunk:
+            yield chunk[1:]
+            break
+    yield from chunks
+
+
+# Names a block in profiles
+def block_name(block: Block) -> str:
+    return f"line {block.line_no}: {' '.join(block.tokens[1:])}"
+
+
+# Writes the function files of a `generate` block, which only see the block's own variables
+def generate_functions(block: Block, path: str):
+    with profile.span(block_name(block)):
+        write_generated_functions(block, path)
+
+def write_generated_functions(block: Block, path: str):
+    ref = function_ref(path, block.line_no)
+    if len(block.tokens) < 3:
+        l.fatal("Missing file name in 'generate' block", ref)
+
+    name = block.tokens[2]
+    loop, dispatch = split_dispatch(block.tokens[3:], ref)
+    variables, items = parse_for_loop(loop, ref)
+    if profile.active:
+        profile.expansions(block_name(block), len(items))
+    leaves = []
+    for item in items:
+        check_replacements(variables, item, ref)
+        filename = bulk_replace(name, variables, item)
+        if filename == name:
+            l.fatal(f"Function file names in 'generate' must include a variable from the for loop (cannot create duplicate file names)", ref)
+
+        out_path = generated_function_path(path, filename)
+        with open_output(out_path, ref=ref, minify=True) as output:
+            for chunk in render_nodes(block.children, path, tuple(item)):
+                output.write(chunk)
+        if dispatch:
+            command = bulk_replace(dispatch.command, variables, item) if dispatch.command else f"function {function_id(out_path)}"
+            leaves.append((item_key(item, ref), command))
+
+    if dispatch:
+        template = None
+        if dispatch.macro:
+            # The command with only the key, which the macro puts in
+            if dispatch.command:
+                template = bulk_replace(dispatch.command, variables[:1], [MACRO_KEY])
+            else:
+                template = f"function {function_id(generated_function_path(path, bulk_replace(name, variables[:1], [MACRO_KEY])))}"
+        write_dispatch(dispatch, leaves, template, function_folder(path), ref)
+
+def generated_function_path(path: str, filename: str) -> str:
+    return os.path.join(config["data_out"], path[2:], f"../{filename}.mcfunction")
+
+
+# Writes the functions making up a `generate` block's dispatcher into the datapack's `folder` ("function" or "functions").
+# `template` is the command with the key replaced by `$(key)`, for macro dispatchers.
+def write_dispatch(dispatch: Dispatch, leaves: list[tuple[int, str]], template: str | None, folder: str, ref: str):
+    with profile.span(f"dispatch {dispatch.function}"):
+        for [function, lines] in dispatch.functions(leaves, template, ref).items():
+            namespace, function_path = function.split(":", 1)
+            write_output(os.path.join(config["data_out"], "data", namespace, folder, function_path + ".mcfunction"), "\n".join(lines) + "\n", ref)
+
+# Returns the folder that functions go in ("function", or "functions" before 1.21) for the namespace a source is in.
+# Json files aren't in it, so it's the one the namespace already has, or else plural if their own folder is.
+def function_folder(path: str) -> str:
+    parts = os.path.normpath(path).split(os.sep)
+    if parts[2] in ("function", "functions"):
+        return parts[2]
+    for folder in ("functions", "function"):
+        if os.path.isdir(project_path(os.path.join(*parts[:2], folder))):
+            return folder
+    kind = parts[3] if parts[2] == "tags" and len(parts) > 4 else parts[2]
+    return "functions" if kind.endswith("s") else "function"
+
+# Returns the id (`namespace:path`) of a function file in the datapack being built
+def function_id(out_path: str) -> str:
+    parts = os.path.relpath(os.path.normpath(out_path), config["data_out"]).split(os.sep)
+    return f"{parts[1]}:{'/'.join(parts[3:]).removesuffix('.mcfunction')}"
 
 
 def get_variable_from_config(name: str, ref: str):
+    variables_read.add(name)
     if name in config["variables"]:
         return config["variables"][name]
+    if name in config["variable_files"]:
+        return variable_files.load(name, config["variable_files"][name], ref)
     l.fatal(f"Failed to find variable '{name}' in config.", ref)
 
 
@@ -101,41 +723,7 @@ def parse_using(tokens: list[str], err_ref: str) -> (list[str], list[object]):
     replacements = [get_variable_from_config(token, err_ref) for token in tokens[3].split(",")]
     return variables, replacements
 
-def using_variable(tokens: list[str], lines: Consumable, path: str) -> str:
-    variables, replacements = parse_using(tokens, function_ref(path, lines.index))
-
-    if any([isinstance(replacement, dict) or isinstance(replacement, list) for replacement in replacements]):
-        l.fatal("Variable used in 'using' block must be a string or number.")
-
-    output: list[str] = []
-
-    while True:
-        line = lines.preview()
-
-        # Stop parsing when the closing comment "#@" is reached
-        if line.strip() == "#@":
-            lines.consume()
-            break
-
-        output.append(handle_line(lines, path))
-
-    return bulk_replace("\n".join(output), variables, replacements, function_ref(path, lines.index))
-
-
-def file_generations(tokens: list[str], lines: Consumable, path: str):
-    functions, variables, replacementss = function_for_loop(tokens[2:], lines, path)
-
-    for [function, replacements] in zip(functions, replacementss):
-        filename = bulk_replace(tokens[2], variables, replacements)
-        if filename == tokens[2]:
-            l.fatal(f"Function file names in 'generate' must include a variable from the for loop (cannot create duplicate file names)", function_ref(path, lines.index))
-
-        write(os.path.join(config["data_out"], path[2:], f"../{filename}.mcfunction"), function)
-
-def map_to_nested(li: Iterable):
-    return [(i,) for i in li]
-
-def parse_for_loop(tokens: list[str], ref: str) -> (list[str], list):
+def parse_for_loop(tokens: list[str], ref: str) -> (list[str], list | LoopItems):
     if len(tokens) < 4:
         l.fatal(f"Too few tokens in for loop in tmcf comment - expected 'for <variable(s)> in <<list> | 'range' | 'enum'>'", ref)
 
@@ -150,25 +738,27 @@ def parse_for_loop(tokens: list[str], ref: str) -> (list[str], list):
         if len(tokens) != 5:
             l.fatal(f"Incorrect number of tokens for range for loop in tmcf comment - expected 'range <start>:<end>[:<step>]'", ref)
 
-        if tokens[4] in config["variables"]:
-            args = config["variables"][tokens[4]]
+        # Recorded even if it isn't a variable, so that adding one with that name rebuilds this file
+        variables_read.add(tokens[4])
+        if tokens[4] in config["variables"] or tokens[4] in config["variable_files"]:
+            args = get_variable_from_config(tokens[4], ref)
             if isinstance(args, list):
-                items = map_to_nested(range(*args))
+                items = LoopItems(range(*args))
             elif isinstance(args, int):
-                items = map_to_nested(range(args))
+                items = LoopItems(range(args))
             else:
                 l.fatal("Internal error - this is an impossible state.")
         else:
             t = tokens[4].split(":")
             if not all([a.isnumeric() for a in t]):
                 l.fatal(f"Invalid arguments '{tokens[4]}' to range for loop in tmcf comment - expected 'range <start>:<end>[:<step>]'", ref)
-            items = map_to_nested(range(*[int(a) for a in t]))
+            items = LoopItems(range(*[int(a) for a in t]))
 
     elif replacement == "enum":
         if len(tokens) != 5:
             l.fatal(f"Incorrect number of tokens for enumeration for loop in tmcf comment - expected 'enum <varname>'", ref)
 
-        items = list(enumerate(get_variable_from_config(tokens[4], ref)))
+        items = LoopItems(get_variable_from_config(tokens[4], ref), enumerated=True)
 
     else:
         items = get_variable_from_config(replacement, ref)
@@ -177,46 +767,37 @@ def parse_for_loop(tokens: list[str], ref: str) -> (list[str], list):
         if any([isinstance(i, list) for i in items]) and not nested:
             l.fatal(f"Variable '{replacement}' contains mixed types.")
         if not nested:
-            items = map_to_nested(items)
-        if not isinstance(items, list):
+            items = LoopItems(items)
+        if not isinstance(items, list | LoopItems):
             l.fatal(f"Variable '{replacement}' used in for loop is not a list", ref)
 
     return variables, items
 
-def function_for_loop(tokens: list[str], lines: Consumable, path: str) -> (list[str], list[str], list):
-    # File reference of the function, to be used if an error is found
-    ref = function_ref(path, lines.index)
-    variables, items = parse_for_loop(tokens[1:], ref)
-    # Lines of text in the comment "block" defined with #@
-    block_lines: list[str] = []
-
-    while True:
-        block_line = lines.preview()
+def bulk_replace(s: str, replacees: list[str], replacements: list, ref: str = None) -> str:
+    # Replaces each instance of a substring in `s` in `replacees` with the corresponding replacement from `replacements`
+    check_replacements(replacees, replacements, ref)
+    with profile.timer("replace"):
+        return substitution(tuple(replacees)).apply(s, replacements, config["chained_replace"])
 
-        # Stop parsing when the closing comment "#@" is reached
-        if block_line.strip() == "#@":
-            lines.consume()
-            break
+def check_replacements(replacees: list[str], replacements: list, ref: str = None):
+    if len(replacees) != len(replacements):
+        l.fatal("Mismatch in number of variables and number of items in list", ref)
 
-        block_lines.append(handle_line(lines, path))
+# Splits `s` on the variable names ahead of time, for text that is substituted once per loop item
+def replace_plan(s: str, replacees: list[str]) -> Plan:
+    return substitution(tuple(replacees)).plan(s)
 
-    # Handle blocks that contain commented-out commands in order to not have IDE errors
-    if all([line.startswith("#") for line in block_lines]):
-        output = "\n".join([line[1:] for line in block_lines])
-    else:
-        output = "\n".join(block_lines)
+# Like `bulk_replace`, for text that has already been split by `replace_plan`
+def render_plan(plan: Plan, replacements: list, ref: str = None) -> str:
+    check_replacements(plan.substitution.names, replacements, ref)
+    with profile.timer("replace"):
+        return plan.render(replacements, config["chained_replace"])
 
-    return [bulk_replace(output, variables, item) for item in items], variables, items
-
-def bulk_replace(s: str, replacees: list[str], replacements: list, ref: str = None) -> str:
-    # Replaces each instance of a substring in `s` in `replacees` with the corresponding replacement from `replacements`
-    output = s
-    try:
-        for [variable_name, value] in zip(replacees, replacements, strict=True):
-            output = output.replace(variable_name, str(value))
-    except ValueError:
-        l.fatal("Mismatch in number of variables and number of items in list", ref)
-    return output
+# Applies the `global_replace` table for a kind of file ("function" or "json")
+def global_replace(s: str, kind: str) -> str:
+    table, values = replace_tables[kind]
+    with profile.timer("replace"):
+        return table.apply(s, values, config["chained_replace"], replaced)
 
 def process_json(object: dict | list, path: str, parent: dict | list = None):
     if isinstance(object, list):
@@ -234,53 +815,97 @@ def process_json(object: dict | list, path: str, parent: dict | list = None):
             if not len(tokens) > 0:
                 l.fatal(f"Missing token in 'tmcf' json key - expected 'for', 'generate' or 'using'", generic_ref(path))
 
-            match tokens[0]:
-                case "for":
-                    if not isinstance(parent, list):
-                        l.fatal("For loops in json files can only be used in objects inside arrays", generic_ref(path))
-
-                    parent.remove(object)
-                    object.pop("tmcf")
-
-                    variables, items = parse_for_loop(tokens, generic_ref(path))
-                    self = json.dumps(object)
-
-                    for [i, replacements] in enumerate(items):
-                        try:
-                            replaced = json.loads(bulk_replace(self, variables, replacements, generic_ref(path)))
-                        except json.JSONDecodeError:
-                            print(bulk_replace(json.dumps(self, indent=4), variables, replacements))
-                            l.fatal("Json decode error. Output shown above", generic_ref(path))
-                            return # keeps pycharm happy
-                        # this is cursed but works
-                        if i == 0:
-                            process_json(replaced, path, object)
-                        parent.append(replaced)
-                    return
-                case "generate":
-                    if parent:
-                        l.fatal("File generation in json files can only be used in the root object", generic_ref(path))
-                    object.pop("tmcf")
-
-                    variables, items = parse_for_loop(tokens[2:], generic_ref(path))
-                    process_json(object, path)
-                    self = json.dumps(object)
-
-                    for replacements in items:
-                        filename = bulk_replace(tokens[1], variables, replacements)
-                        write(os.path.join(config["data_out"], path[2:], f"../{filename}.json"), bulk_replace(self, variables, replacements))
-                    return
-                case "using":
-                    variables, replacements = parse_using(tokens, generic_ref(path))
-
-                    parent.remove(object)
-                    object.pop("tmcf")
-                    self = json.dumps(object)
-                    try:
-                        parent.append(json.loads(bulk_replace(self, variables, replacements, generic_ref(path))))
-                    except json.JSONDecodeError:
-                        print(bulk_replace(json.dumps(self, indent=4), variables, replacements))
-                        l.fatal("Json decode error. Output shown above", generic_ref(path))
-                    return
-                case _ as t:
-                    l.fatal(f"Unexpected token '{t}' in 'tmcf' json key  - expected 'for', 'generate' or 'using'", generic_ref(path))
\ No newline at end of file
+            with profile.span(f"tmcf: {value}"):
+                process_tmcf(object, tokens, path, parent)
+            return
+
+# Expands the object holding a 'tmcf' key into `parent`, or into generated files
+def process_tmcf(object: dict, tokens: list[str], path: str, parent: dict | list):
+    match tokens[0]:
+        case "for":
+            if not isinstance(parent, list):
+                l.fatal("For loops in json files can only be used in objects inside arrays", generic_ref(path))
+
+            parent.remove(object)
+            object.pop("tmcf")
+
+            variables, items = parse_for_loop(tokens, generic_ref(path))
+            profile.expansions(f"tmcf: {' '.join(tokens)}", len(items))
+            for [i, replaced] in enumerate(expand_json(object, variables, items, generic_ref(path))):
+                # this is cursed but works
+                if i == 0:
+                    process_json(replaced, path, object)
+                parent.append(replaced)
+            return
+        case "generate":
+            if parent:
+                l.fatal("File generation in json files can only be used in the root object", generic_ref(path))
+            object.pop("tmcf")
+
+            loop, dispatch = split_dispatch(tokens[2:], generic_ref(path))
+            if dispatch and not dispatch.command:
+                l.fatal("Dispatchers in json files need a command to run for each item, like 'run loot give @s loot ns:loot_i'", generic_ref(path))
+            variables, items = parse_for_loop(loop, generic_ref(path))
+            profile.expansions(f"tmcf: {' '.join(tokens)}", len(items))
+            process_json(object, path)
+            plan = replace_plan(compact_json(object) if config["release"] else json.dumps(object), variables)
+            if config["release"]:
+                # The values put in are the same either way, so each file is smaller by the same amount
+                saved = len(json.dumps(object).encode()) - len(plan.text.encode())
+
+            for replacements in items:
+                filename = bulk_replace(tokens[1], variables, replacements)
+                contents = render_plan(plan, replacements, generic_ref(path))
+                if config["release"]:
+                    size = len(contents.encode())
+                    minified_sizes[0] += size + saved
+                    minified_sizes[1] += size
+                write_output(os.path.join(output_root(path), path[2:], f"../{filename}.json"), global_replace(contents, "json"), generic_ref(path))
+
+            if dispatch:
+                leaves = [(item_key(item, generic_ref(path)), bulk_replace(dispatch.command, variables, item)) for item in items]
+                template = bulk_replace(dispatch.command, variables[:1], [MACRO_KEY]) if dispatch.macro else None
+                write_dispatch(dispatch, leaves, template, function_folder(path), generic_ref(path))
+            return
+        case "using":
+            variables, replacements = parse_using(tokens, generic_ref(path))
+            profile.expansions(f"tmcf: {' '.join(tokens)}", 1)
+
+            parent.remove(object)
+            object.pop("tmcf")
+            parent.extend(expand_json(object, variables, [replacements], generic_ref(path)))
+            return
+        case _ as t:
+            l.fatal(f"Unexpected token '{t}' in 'tmcf' json key  - expected 'for', 'generate' or 'using'", generic_ref(path))
+
+# Makes a copy of a json object for each of `items`, with the variables replaced
+def expand_json(object: dict, variables: list[str], items: list | LoopItems, ref: str) -> Iterator[dict]:
+    chained = config["chained_replace"]
+    compiled = template.compile_json(object, tuple(variables), chained) if len(items) >= COMPILE_JSON_MIN else None
+    plan = None
+
+    for replacements in items:
+        check_replacements(variables, replacements, ref)
+        copy = compiled_copy(compiled, replacements) if compiled is not None else None
+        if copy is not None:
+            yield copy
+            continue
+
+        # Replacements that could change the structure of the object go through its text instead
+        if plan is None:
+            plan = replace_plan(json.dumps(object), variables)
+        try:
+            yield json.loads(plan.render(replacements, chained))
+        except json.JSONDecodeError:
+            print(bulk_replace(json.dumps(plan.text, indent=4), variables, replacements))
+            l.fatal("Json decode error. Output shown above", ref)
+
+# Builds a copy of a compiled json object, or returns None if the replacements can't be put in as they are
+def compiled_copy(compiled, replacements: list) -> dict | None:
+    strings = [str(value) for value in replacements]
+    if not all(map(template.json_safe, strings)):
+        return None
+    try:
+        return compiled.render(replacements, strings)
+    except json.JSONDecodeError:
+        return None
@@ -0,0 +1,76 @@
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from tmcf import template, utils
+from tmcf.command import build
+from tmcf.config import ConfigType
+from tmcf.index import ProjectIndex
+from tmcf.logging import l, FatalError, generic_ref
+from tmcf.utils import hash_file, project_path
+
+
+# Builds every function and json file without writing anything, to find errors without touching the build
+# (for CI and pre-commit hooks). The config is read by `load_config`. Every file that fails is reported
+# rather than stopping at the first one, and the process exits with status 1 if any did.
+def check(load_config, jobs: int = 1):
+    start = time.perf_counter()
+    try:
+        with l.raising():
+            config = load_config()
+    except FatalError as e:
+        fail([(e.ref, e.message)], "reading the config", start)
+    project_index = ProjectIndex.load()
+    project_index.scan()
+    sources = project_index.files("function") + project_index.files("json")
+
+    if jobs > 1 and len(sources) > 1:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=init_checker, initargs=(config,)) as executor:
+            results = list(executor.map(check_source, sources, chunksize=max(1, len(sources) // (jobs * 4))))
+    else:
+        init_checker(config)
+        results = [check_source(path) for path in sources]
+
+    errors = [error for error in results if error]
+    try:
+        with open(project_path("./pack.mcmeta"), "r") as f:
+            json.load(f)
+    except (OSError, ValueError) as e:
+        errors.append((None, f"Failed to read 'pack.mcmeta': {e}"))
+
+    if errors:
+        fail(errors, f"checking {len(sources)} file(s)", start)
+    l.success(f"Checked {len(sources)} file(s) in {(time.perf_counter() - start) * 1000:.0f}ms, no errors found")
+
+
+# Shows every error and exits with status 1 (unlike `l.fatal`) so CI notices
+def fail(errors: list[tuple[str | None, str]], doing: str, start: float):
+    for [ref, message] in errors:
+        l.error(message, ref)
+    l.print(f"Found {len(errors)} error(s) {doing} in {(time.perf_counter() - start) * 1000:.0f}ms", l.RED)
+    sys.stdout.flush()
+    sys.exit(1)
+
+
+# Sets up a process to build files without writing them, raising errors instead of exiting
+def init_checker(config: ConfigType):
+    build.use_config(config)
+    l.raise_errors = True
+    utils.discard_writes = True
+    if not build.templates:
+        build.templates.update(template.load_cache())
+
+
+# Builds a source, returning where it failed and why, or None if it built
+def check_source(path: str) -> tuple[str | None, str] | None:
+    try:
+        build.build_source(path, hash_file(path))
+    except FatalError as e:
+        return e.ref, e.message
+    except json.JSONDecodeError as e:
+        return generic_ref(path), f"Json decode error: {e}"
+    except (OSError, UnicodeDecodeError) as e:
+        return generic_ref(path), f"Failed to read '{os.path.normpath(path)}': {e}"
+    return None
@@ -0,0 +1,308 @@
+import itertools
+import json
+import os
+from functools import lru_cache
+
+from tmcf import template
+from tmcf.command import build
+from tmcf.config import ConfigType
+from tmcf.dispatch import split_dispatch
+from tmcf.index import ProjectIndex
+from tmcf.logging import l, function_ref, generic_ref
+from tmcf.manifest import Manifest
+from tmcf.template import Block, Text
+from tmcf.utils import hash_file, project_path
+
+# Settings allowed in `[limits]`, with what each one limits
+LIMITS = {
+    "files": "files written by the build",
+    "bytes": "bytes written by the build",
+    "file_bytes": "bytes in a single file",
+    "expansions": "loop expansions in a single source file",
+}
+# How many of a loop's items are measured to estimate how long its values are
+SAMPLE_SIZE = 1024
+# How many source files are listed in a plan
+PLAN_LIST_LIMIT = 20
+
+# What building a source file, or a block in one, is expected to produce. Sizes are estimated from how long
+# the loops' values are, without rendering anything.
+class Estimate:
+    name: str
+    ref: str
+    # How many times the bodies of loops are expanded
+    expansions: int
+    files: int
+    bytes: float
+    # Estimated size of the largest file written
+    largest: float
+    # The blocks in a source file
+    blocks: list
+
+    def __init__(self, name: str, ref: str):
+        self.name = name
+        self.ref = ref
+        self.expansions = 0
+        self.files = 0
+        self.bytes = 0
+        self.largest = 0
+        self.blocks = []
+
+    def add_files(self, count: int, size: float):
+        if count:
+            self.files += count
+            self.bytes += count * size
+            self.largest = max(self.largest, size)
+
+    # Adds the files written by one of the file's blocks
+    def add_block_files(self, block):
+        self.files += block.files
+        self.bytes += block.bytes
+        self.largest = max(self.largest, block.largest)
+
+
+# Works out what building every function and json file would produce, without building anything.
+# Loops are counted from their variables, so variables from files are loaded, but nothing is rendered or written.
+# Given the manifest of the build, sources it won't rebuild use the estimate it recorded for them, and the
+# estimates of the rest are recorded in it.
+def plan_pack(sources: list[str], manifest: Manifest = None) -> list[Estimate]:
+    if not build.templates:
+        build.templates.update(template.load_cache())
+    estimates = []
+    for path in [path for path in sources if build.source_builder(path)]:
+        recorded = manifest.estimates.get(path) if manifest else None
+        if recorded and manifest.is_current(path, hash_file(path)):
+            estimates.append(recorded_estimate(path, recorded))
+            continue
+        estimate = plan_source(path)
+        if manifest:
+            manifest.estimates[path] = [estimate.expansions, estimate.files, estimate.bytes, estimate.largest]
+        estimates.append(estimate)
+    return estimates
+
+def recorded_estimate(path: str, recorded: list) -> Estimate:
+    estimate = Estimate(os.path.normpath(path), generic_ref(path))
+    estimate.expansions, estimate.files, estimate.bytes, estimate.largest = recorded
+    return estimate
+
+def plan_source(path: str) -> Estimate:
+    if build.source_builder(path) is build.build_function:
+        return plan_function(path)
+    return plan_json(path)
+
+
+# Prints the plan for a pack (`tmcf --plan`), and whether it's within the limits in `tmcf.toml`
+def show_plan(config: ConfigType):
+    build.use_config(config)
+    project_index = ProjectIndex.load()
+    project_index.scan()
+    estimates = plan_pack(project_index.files("function") + project_index.files("json"))
+
+    l.print(f"Building {len(estimates)} source file(s) would expand loops {total(estimates, 'expansions'):,} time(s), "
+            f"writing {total(estimates, 'files'):,} file(s) ({size(total(estimates, 'bytes'))}):", l.BOLD)
+    listed = sorted([estimate for estimate in estimates if estimate.blocks], key=lambda estimate: -estimate.bytes)
+    for estimate in listed[:PLAN_LIST_LIMIT]:
+        l.print(f"  {estimate.name}: {describe(estimate)}")
+        for block in estimate.blocks:
+            l.print(f"    {block.name}: {describe(block)}")
+    if len(listed) > PLAN_LIST_LIMIT:
+        l.print(f"  ...and {len(listed) - PLAN_LIST_LIMIT} more")
+
+    exceeded = exceeded_limits(estimates, config["limits"])
+    for [message, ref] in exceeded:
+        l.error(message, ref)
+    if exceeded:
+        l.warn(f"The build would go over {len(exceeded)} limit(s) in `tmcf.toml`, so it would stop before building anything")
+    elif config["limits"]:
+        l.success("Within the limits in `tmcf.toml`")
+
+
+# Stops before anything is built if the pack would go over any of the limits in `tmcf.toml`, failing the process
+# so that CI notices
+def check_limits(estimates: list[Estimate], limits: dict):
+    exceeded = exceeded_limits(estimates, limits)
+    if not exceeded:
+        return
+    for [message, ref] in exceeded:
+        l.error(message, ref)
+    l.fatal(f"The build would go over {len(exceeded)} limit(s) in `tmcf.toml`, so nothing was built. Run `tmcf --plan` for details.", status=1)
+
+# Returns a message and ref for every limit the pack would go over
+def exceeded_limits(estimates: list[Estimate], limits: dict) -> list[tuple[str, str | None]]:
+    exceeded = []
+    for key in ["files", "bytes"]:
+        if key in limits and total(estimates, key) > limits[key]:
+            exceeded.append((f"The build would write about {amount(total(estimates, key), key)}, over the limit of {amount(limits[key], key)}", None))
+    for estimate in estimates:
+        if "file_bytes" in limits and estimate.largest > limits["file_bytes"]:
+            exceeded.append((f"A file built from this would be about {size(estimate.largest)}, over the limit of {size(limits['file_bytes'])} for a single file", estimate.ref))
+        if "expansions" in limits and estimate.expansions > limits["expansions"]:
+            exceeded.append((f"Loops would be expanded {estimate.expansions:,} time(s), over the limit of {limits['expansions']:,}", estimate.ref))
+    return exceeded
+
+
+def plan_function(path: str) -> Estimate:
+    estimate = Estimate(os.path.normpath(path), generic_ref(path))
+    nodes = build.compiled_function(path, hash_file(path))
+    # Files with nothing in them aren't written
+    if main := nodes_size(nodes, path, (), 1, estimate):
+        estimate.add_files(1, main + 1)
+    for block in template.generate_blocks(nodes):
+        plan_generate(block, path, estimate)
+    return estimate
+
+# Returns the estimated size of rendering `nodes` once, given the average length of the value of each variable
+# in scope (innermost first). `times` is how many times the nodes are rendered, for counting expansions.
+def nodes_size(nodes: list, path: str, lengths: tuple, times: int, estimate: Estimate) -> float:
+    total_size = max(len(nodes) - 1, 0)
+    for node in nodes:
+        if isinstance(node, Text):
+            total_size += plan_size(node.plan, lengths)
+        elif node.kind != "generate":
+            total_size += block_size(node, path, lengths, times, estimate)
+    return total_size
+
+def block_size(block: Block, path: str, lengths: tuple, times: int, estimate: Estimate) -> float:
+    ref = function_ref(path, block.line_no)
+    if block.kind == "for":
+        variables, items = build.parse_for_loop(block.tokens[1:], ref)
+    else:
+        variables, replacements = build.parse_using(block.tokens[1:], ref)
+        items = [replacements]
+
+    planned = Estimate(build.block_name(block), ref)
+    estimate.blocks.append(planned)
+    planned.expansions = times * len(items)
+    estimate.expansions += planned.expansions
+    body = nodes_size(block.children, path, value_lengths(variables, items, ref) + lengths, planned.expansions, estimate)
+    block_bytes = len(items) * body + max(len(items) - 1, 0)
+    planned.bytes = times * block_bytes
+    return block_bytes
+
+def plan_generate(block: Block, path: str, estimate: Estimate):
+    ref = function_ref(path, block.line_no)
+    if len(block.tokens) < 3:
+        l.fatal("Missing file name in 'generate' block", ref)
+    loop, dispatch = split_dispatch(block.tokens[3:], ref)
+    variables, items = build.parse_for_loop(loop, ref)
+
+    planned = Estimate(build.block_name(block), ref)
+    estimate.blocks.append(planned)
+    planned.expansions = len(items)
+    estimate.expansions += len(items)
+    planned.add_files(len(items), nodes_size(block.children, path, value_lengths(variables, items, ref), len(items), estimate))
+    if dispatch:
+        add_dispatch(planned, dispatch, len(items))
+    estimate.add_block_files(planned)
+
+
+def plan_json(path: str) -> Estimate:
+    estimate = Estimate(os.path.normpath(path), generic_ref(path))
+    try:
+        with open(project_path(path), "r") as f:
+            j = json.load(f)
+    except json.JSONDecodeError as e:
+        l.fatal(f"Json decode error: {e}", generic_ref(path))
+    extra = json_blocks(j, path, estimate, 0)
+    estimate.add_files(1, len(dump(j)) + extra)
+    return estimate
+
+# Adds the `tmcf` blocks in a json value `depth` levels into the file to the estimate, returning how many
+# bytes they add to the file
+def json_blocks(value, path: str, estimate: Estimate, depth: int) -> float:
+    extra = 0
+    children = value.values() if isinstance(value, dict) else value
+    for child in children:
+        if isinstance(child, dict | list):
+            extra += json_blocks(child, path, estimate, depth + 1)
+    if isinstance(value, dict) and isinstance(value.get("tmcf"), str):
+        extra += json_block(value, value["tmcf"].split(" "), path, estimate, depth)
+    return extra
+
+def json_block(object: dict, tokens: list[str], path: str, estimate: Estimate, depth: int) -> float:
+    ref = generic_ref(path)
+    dispatch = None
+    match tokens[0]:
+        case "for":
+            variables, items = build.parse_for_loop(tokens, ref)
+        case "generate":
+            loop, dispatch = split_dispatch(tokens[2:], ref)
+            variables, items = build.parse_for_loop(loop, ref)
+        case "using":
+            variables, replacements = build.parse_using(tokens, ref)
+            items = [replacements]
+        case _:
+            return 0
+
+    planned = Estimate(f"tmcf: {' '.join(tokens)}", ref)
+    estimate.blocks.append(planned)
+    planned.expansions = len(items)
+    estimate.expansions += len(items)
+    copy = {key: value for [key, value] in object.items() if key != "tmcf"}
+    text = dump(copy)
+    object_size = plan_size(build.replace_plan(text, variables), value_lengths(variables, items, ref))
+
+    if tokens[0] != "generate":
+        # The object is replaced by its copies, each indented as deep as it is in the file
+        if not build.config["release"]:
+            object_size += text.count("\n") * 2 * depth
+        planned.bytes = len(items) * object_size
+        return planned.bytes - len(dump(object))
+    planned.add_files(len(items), object_size)
+    if dispatch:
+        add_dispatch(planned, dispatch, len(items))
+    estimate.add_block_files(planned)
+    return 0
+
+
+# Adds the functions making up a dispatcher for `count` items
+def add_dispatch(planned: Estimate, dispatch, count: int):
+    line = len(f"execute if score {dispatch.target} {dispatch.objective} matches 0..0 run function {dispatch.function}")
+    if dispatch.macro:
+        planned.add_files(2, 2 * line)
+    else:
+        planned.add_files(dispatch_functions(count), 2 * line)
+
+# Returns how many functions a dispatcher for `count` items is split into (see `tmcf.dispatch.Dispatch.node`)
+@lru_cache(maxsize=None)
+def dispatch_functions(count: int) -> int:
+    return 1 + sum(dispatch_functions(part) for part in [(count + 1) // 2, count // 2] if part > 1)
+
+
+# Returns the average length of each variable's values, measured on the first items of a loop
+def value_lengths(variables: list[str], items, ref: str) -> tuple[float, ...]:
+    sample = list(itertools.islice(iter(items), SAMPLE_SIZE))
+    for item in sample:
+        build.check_replacements(variables, item, ref)
+    if not sample:
+        return (0,) * len(variables)
+    return tuple(sum(len(str(item[i])) for item in sample) / len(sample) for i in range(len(variables)))
+
+# Returns the estimated size of a run of text once the variables in it are replaced
+def plan_size(plan, lengths: tuple) -> float:
+    return sum(map(len, plan.literals)) + sum(lengths[i] for i in plan.indices)
+
+def dump(j) -> str:
+    return build.compact_json(j) if build.config["release"] else json.dumps(j, indent=2)
+
+
+def total(estimates: list[Estimate], key: str) -> int:
+    return round(sum(getattr(estimate, key) for estimate in estimates))
+
+def describe(estimate: Estimate) -> str:
+    parts = [f"{estimate.expansions:,} expansion(s)"]
+    if estimate.files:
+        parts.append(f"{estimate.files:,} file(s)")
+    return ", ".join(parts) + f", about {size(estimate.bytes)}"
+
+def amount(value: int, key: str) -> str:
+    return size(value) if key == "bytes" else f"{value:,} file(s)"
+
+def size(value: float) -> str:
+    if value >= 1 << 30:
+        return f"{value / (1 << 30):.1f} GB"
+    if value >= 1 << 20:
+        return f"{value / (1 << 20):.1f} MB"
+    if value >= 1 << 10:
+        return f"{value / (1 << 10):.1f} KB"
+    return f"{round(value)} bytes"
@@ -0,0 +1,99 @@
+import os
+import time
+
+from tmcf.config import ConfigType
+from tmcf.logging import l
+from tmcf.command import build
+
+# Seconds between checks of the project for changes
+POLL_INTERVAL = 0.25
+# Seconds without any further changes before a burst of saves is rebuilt
+DEBOUNCE = 0.2
+
+WATCHED_FILES = ["./pack.mcmeta", "./tmcf.toml"]
+WATCHED_DIRS = ["./data", "./assets"]
+
+
+# Returns the size and modification time of every file that affects the build
+def snapshot(config: ConfigType) -> dict[str, tuple[int, int]]:
+    files = {}
+    paths = WATCHED_FILES + variable_paths(config)
+    for directory in WATCHED_DIRS:
+        for root, _, filenames in os.walk(directory):
+            paths += [os.path.join(root, name) for name in filenames]
+
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            files[path] = (stat.st_size, stat.st_mtime_ns)
+        except OSError:
+            pass
+    return files
+
+
+# Files that variables are loaded from
+def variable_paths(config: ConfigType) -> list[str]:
+    return [source["path"] for source in config["variable_files"].values()]
+
+
+# Waits for the project to change, then for the changes to settle, returning the new snapshot
+def wait_for_changes(previous: dict, config: ConfigType) -> dict:
+    current = previous
+    while current == previous:
+        time.sleep(POLL_INTERVAL)
+        current = snapshot(config)
+
+    while True:
+        time.sleep(DEBOUNCE)
+        settled = snapshot(config)
+        if settled == current:
+            return current
+        current = settled
+
+
+def watch(config: ConfigType, load_config, jobs: int = 1):
+    # The same worker processes build every rebuild, instead of starting new ones each time
+    with build.keep_workers():
+        watch_changes(config, load_config, jobs)
+
+def watch_changes(config: ConfigType, load_config, jobs: int):
+    manifest = build.build_pack(config, incremental=True, jobs=jobs)
+    files = snapshot(config)
+    l.print("Watching for changes... (Ctrl+C to stop)", l.CYAN)
+
+    try:
+        while True:
+            previous = files
+            files = wait_for_changes(previous, config)
+            changed = [path for path, stat in files.items() if previous.get(path) != stat]
+            removed = [path for path in previous if path not in files]
+
+            start = time.perf_counter()
+            try:
+                # The config is only re-read when it changes, which rebuilds the files that use what changed in it
+                if "./tmcf.toml" in changed:
+                    config = load_config()
+                    manifest = build.build_pack(config, incremental=True, jobs=jobs)
+                    summary = "the files affected by `tmcf.toml`"
+                elif any(path in changed for path in variable_paths(config)):
+                    # Only the sources using the variables that changed are rebuilt, along with any other changes
+                    manifest = build.build_pack(config, incremental=True, jobs=jobs)
+                    summary = "the files affected by variable files"
+                elif config["zip"]:
+                    # Zips can't be updated in place
+                    manifest = build.build_pack(config, jobs=jobs)
+                    summary = "everything"
+                else:
+                    if "./pack.mcmeta" in changed:
+                        build.copy_pack_meta()
+                    summary = f"{build.update_pack(manifest, changed, removed, jobs)} file(s)"
+            except (SystemExit, OSError) as e:
+                # Errors have already been reported by `l.fatal`, so keep watching
+                if isinstance(e, OSError):
+                    l.print(str(e), l.RED)
+                l.warn("Build failed, waiting for changes...")
+                continue
+
+            l.success(f"Rebuilt {summary} in {(time.perf_counter() - start) * 1000:.1f}ms")
+    except KeyboardInterrupt:
+        l.print("Stopped watching.", l.CYAN)
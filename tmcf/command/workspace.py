@@ -0,0 +1,124 @@
+import contextlib
+import io
+import os
+import time
+import tomllib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from tmcf import utils
+from tmcf.command import build
+from tmcf.config import ConfigType
+from tmcf.logging import l, FatalError
+
+WORKSPACE_FILE = "./tmcf-workspace.toml"
+
+
+# Reads `tmcf-workspace.toml`, which lists the packs in the workspace (`members`, as paths relative to it)
+# along with the `[variables]` and `[global_replace]` tables they share
+def load_workspace() -> dict:
+    with open(WORKSPACE_FILE, "rb") as toml:
+        try:
+            workspace = tomllib.load(toml)
+        except tomllib.TOMLDecodeError as e:
+            l.fatal(f"Failed to parse 'tmcf-workspace.toml': {e}")
+
+    members = workspace.get("members")
+    if not isinstance(members, list) or not members or not all(isinstance(member, str) for member in members):
+        l.fatal("Key 'members' in 'tmcf-workspace.toml' must be a list of paths to packs")
+    if len(set(members)) != len(members):
+        l.fatal("Key 'members' in 'tmcf-workspace.toml' lists the same pack more than once")
+    for key in ["variables", "global_replace"]:
+        if not isinstance(workspace.setdefault(key, {}), dict):
+            l.fatal(f"'{key}' in 'tmcf-workspace.toml' must be a table")
+    return workspace
+
+
+# Builds the packs in a workspace (or only the `selected` ones), up to `jobs` at a time in separate processes.
+# Every pack's config is read first, given the parsed workspace to share, by `load_config` (run with the pack as the
+# project, see `in_project`).
+# Each pack builds into its own output, and what it prints is kept together and shown once it's done.
+def build_workspace(workspace: dict, load_config, selected: list[str], incremental: bool = False, jobs: int = 1):
+    for member in selected:
+        if member not in workspace["members"]:
+            l.fatal(f"'{member}' is not a member of the workspace")
+    root = os.getcwd()
+    members = selected or workspace["members"]
+
+    configs = {}
+    failed = []
+    for member in members:
+        try:
+            with in_project(os.path.join(root, member)), l.raising():
+                configs[member] = load_config(workspace)
+        except FatalError as e:
+            l.error(f"{member}: {e.message}", e.ref)
+            failed.append(member)
+        except OSError as e:
+            l.error(f"{member}: {e.strerror or e}")
+            failed.append(member)
+    check_outputs(root, configs)
+
+    start = time.perf_counter()
+    if jobs > 1 and len(configs) > 1:
+        with ProcessPoolExecutor(max_workers=min(jobs, len(configs))) as executor:
+            futures = {executor.submit(build_member, os.path.join(root, member), config, incremental, 1, build.explain, True): member
+                       for [member, config] in configs.items()}
+            for future in as_completed(futures):
+                member = futures[future]
+                output, error, elapsed = future.result()
+                l.print(f"{member} ({elapsed * 1000:.0f}ms):", l.BOLD)
+                print(output, end="")
+                if error:
+                    failed.append(member)
+    else:
+        for [member, config] in configs.items():
+            l.print(f"{member}:", l.BOLD)
+            _, error, _ = build_member(os.path.join(root, member), config, incremental, jobs, build.explain)
+            if error:
+                failed.append(member)
+
+    if failed:
+        l.fatal(f"{len(failed)} of {len(members)} pack(s) failed to build: {', '.join(failed)}", status=1)
+    l.success(f"Built {len(members)} pack(s) in {(time.perf_counter() - start) * 1000:.0f}ms")
+
+
+# Stops if two packs would build into the same folder, since their builds would delete each other's files
+def check_outputs(root: str, configs: dict[str, ConfigType]):
+    owners = {}
+    for [member, config] in configs.items():
+        for out in {os.path.normpath(os.path.join(root, member, config[key])) for key in ["data_out", "assets_out"]}:
+            if out in owners:
+                l.fatal(f"Packs '{owners[out]}' and '{member}' both build into '{out}'")
+            owners[out] = member
+
+
+# Builds a single pack, catching the error that stops it so the other packs keep building.
+# Returns what the build printed (if `capture`), the error if it failed, and how long it took.
+def build_member(path: str, config: ConfigType, incremental: bool, jobs: int, explain: bool,
+                 capture: bool = False) -> tuple[str, str | None, float]:
+    output = io.StringIO()
+    error = None
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(output) if capture else contextlib.nullcontext():
+        try:
+            with in_project(path), l.raising():
+                build.explain = explain
+                build.build_pack(config, incremental=incremental, jobs=jobs)
+        except FatalError as e:
+            l.error(e.message, e.ref)
+            error = str(e)
+        except OSError as e:
+            l.error(str(e))
+            error = str(e)
+    return output.getvalue(), error, time.perf_counter() - start
+
+
+# Makes the pack at `path` the project being built within the block, without changing the working directory
+@contextlib.contextmanager
+def in_project(path: str):
+    previous = utils.project_root
+    utils.project_root = path
+    try:
+        yield
+    finally:
+        utils.project_root = previous
@@ -0,0 +1,17 @@
+from typing import TypedDict
+
+class ConfigType(TypedDict):
+    global_replace: dict
+    variables: dict
+    # Variables loaded from files, by name, with the file's `path` and whether it has a `header` row
+    variable_files: dict
+    assets_out: str
+    data_out: str
+    chained_replace: bool
+    zip: bool
+    compression_level: int
+    release: bool
+    # Whether full builds are built beside the previous build and swapped in once they're done
+    staged: bool
+    # The most the build can write or expand, by name (see `tmcf.command.plan.LIMITS`)
+    limits: dict
@@ -0,0 +1,102 @@
+from tmcf.logging import l
+
+# Storage the macro dispatcher passes the score through, in the dispatcher's namespace
+MACRO_STORAGE = "tmcf"
+MACRO_KEY = "$(key)"
+
+# A function that runs the command for one of a `generate` block's items, picked by a score that holds the
+# item's key (the value of the loop's first variable), like `dispatch ns:place @s ns.dir` after the loop.
+# The dispatcher is a balanced tree of `execute if score ... matches` checks, so picking one of N items
+# takes about 2 log2(N) commands instead of N. `macro` passes the score to a macro function instead,
+# which takes a constant number of commands (pack format 18 and above).
+class Dispatch:
+    # The dispatcher's id (`namespace:path`)
+    function: str
+    target: str
+    objective: str
+    macro: bool
+    # The command run for each item, with the loop variables replaced, or None to run the item's generated function
+    command: str | None
+
+    def __init__(self, function: str, target: str, objective: str, macro: bool, command: str | None):
+        self.function = function
+        self.target = target
+        self.objective = objective
+        self.macro = macro
+        self.command = command
+
+    # Returns the lines of every function making up the dispatcher, by id, given each item's key and command.
+    # `template` is the command with the key replaced by `$(key)`, for macro dispatchers.
+    def functions(self, leaves: list[tuple[int, str]], template: str | None, ref: str) -> dict[str, list[str]]:
+        leaves = sorted(leaves)
+        for [[key, _], [next_key, _]] in zip(leaves, leaves[1:]):
+            if key == next_key:
+                l.fatal(f"Key {key} appears more than once in dispatcher '{self.function}'", ref)
+
+        if self.macro:
+            for [key, command] in leaves:
+                if template.replace(MACRO_KEY, str(key)) != command:
+                    l.fatal(f"Macro dispatcher '{self.function}' can only be used when the command for each item only depends on its key", ref)
+            namespace = self.function.split(":")[0]
+            return {
+                self.function: [
+                    f"execute store result storage {namespace}:{MACRO_STORAGE} dispatch.key int 1 run scoreboard players get {self.target} {self.objective}",
+                    f"function {self.function}/macro with storage {namespace}:{MACRO_STORAGE} dispatch"
+                ],
+                f"{self.function}/macro": ["$" + template]
+            }
+
+        functions = {}
+        self.node(self.function, leaves, functions)
+        return functions
+
+    # Adds the function checking which half of `leaves` the score is in, and the functions below it
+    def node(self, function: str, leaves: list[tuple[int, str]], functions: dict[str, list[str]]):
+        lines = []
+        half = (len(leaves) + 1) // 2
+        for part in [leaves[:half], leaves[half:]]:
+            if len(part) == 1:
+                lines.append(f"execute if score {self.target} {self.objective} matches {part[0][0]} run {part[0][1]}")
+            elif part:
+                child = f"{self.function}/{part[0][0]}_{part[-1][0]}"
+                lines.append(f"execute if score {self.target} {self.objective} matches {part[0][0]}..{part[-1][0]} run function {child}")
+                self.node(child, part, functions)
+        functions[function] = lines
+
+
+# Splits the tokens of a `generate` loop into the loop and its dispatcher, if it has one
+def split_dispatch(tokens: list[str], ref: str) -> (list[str], Dispatch | None):
+    # The loop is `for <variables> in <list>`, or `for <variables> in range|enum <argument>`
+    length = 5 if len(tokens) > 3 and tokens[3] in ("range", "enum") else 4
+    if len(tokens) <= length or tokens[length] != "dispatch":
+        return tokens, None
+    return tokens[:length], parse_dispatch(tokens[length + 1:], ref)
+
+# Parses `<function> <target> <objective> [macro] [run <command>]`
+def parse_dispatch(tokens: list[str], ref: str) -> Dispatch:
+    usage = "expected 'dispatch <namespace:function> <target> <objective> [macro] [run <command>]'"
+    if len(tokens) < 3:
+        l.fatal(f"Too few tokens in dispatcher - {usage}", ref)
+
+    function, target, objective = tokens[:3]
+    if ":" not in function:
+        l.fatal(f"Dispatcher '{function}' must be a function id with a namespace - {usage}", ref)
+    rest = tokens[3:]
+    macro = bool(rest) and rest[0] == "macro"
+    if macro:
+        rest = rest[1:]
+
+    command = None
+    if rest:
+        if rest[0] != "run" or len(rest) < 2:
+            l.fatal(f"Unexpected token '{rest[0]}' in dispatcher - {usage}", ref)
+        command = " ".join(rest[1:])
+    return Dispatch(function, target, objective, macro, command)
+
+
+# Returns the key of a loop item, which must be a whole number
+def item_key(item, ref: str) -> int:
+    key = item[0]
+    if not isinstance(key, int) or isinstance(key, bool):
+        l.fatal(f"Dispatchers need a whole number as the loop's first variable, but found '{key}'", ref)
+    return key
@@ -0,0 +1,125 @@
+import json
+import os
+import time
+
+from tmcf.utils import project_path
+
+# Bump whenever the saved format changes, so stale indexes are thrown away instead of loaded
+INDEX_VERSION = 1
+INDEX_PATH = "./.tmcf/index.json"
+ROOTS = ["./data", "./assets"]
+# Directories modified this recently (in nanoseconds) may still change within the same timestamp,
+# so their listing isn't trusted by the next scan
+RACY_WINDOW = 2_000_000_000
+
+# Every file in the project's `data` and `assets` folders, found with a single walk of the tree.
+# Each directory's listing is saved along with its modification time, which only changes when files are
+# added, removed or renamed in it, so later scans only list the directories that have changed.
+class ProjectIndex:
+    # The project directory, since the paths are relative to it
+    root: str
+    # Each directory's modification time (or None if it must be listed again), its files' sizes and
+    # modification times as of when it was listed, and its subdirectories
+    directories: dict[str, dict]
+    # Every file, by its handler ("function", "json" or "passthrough"), in the order a recursive glob finds them
+    groups: dict[str, list[str]]
+
+    def __init__(self, directories: dict[str, dict] = None):
+        self.root = os.path.abspath(project_path("."))
+        self.directories = directories or {}
+        self.groups = {"function": [], "json": [], "passthrough": []}
+
+    @staticmethod
+    def load():
+        try:
+            with open(project_path(INDEX_PATH), "r") as f:
+                data = json.load(f)
+            if data["version"] == INDEX_VERSION:
+                return ProjectIndex(data["directories"])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        return ProjectIndex()
+
+    def save(self):
+        os.makedirs(os.path.dirname(project_path(INDEX_PATH)), exist_ok=True)
+        with open(project_path(INDEX_PATH), "w") as f:
+            json.dump({"version": INDEX_VERSION, "directories": self.directories}, f)
+
+    # Brings the index up to date with the project, returning how many directories had to be listed
+    def scan(self) -> int:
+        previous = self.directories
+        self.directories = {}
+        self.groups = {"function": [], "json": [], "passthrough": []}
+        trusted = time.time_ns() - RACY_WINDOW
+        listed = 0
+        for root in ROOTS:
+            listed += self.scan_directory(root, previous, trusted)
+        return listed
+
+    def scan_directory(self, directory: str, previous: dict[str, dict], trusted: int) -> int:
+        try:
+            mtime = os.stat(project_path(directory)).st_mtime_ns
+        except OSError:
+            return 0
+
+        listed = 0
+        entry = previous.get(directory)
+        if not entry or entry["mtime"] != mtime:
+            entry = list_directory(project_path(directory))
+            listed = 1
+        # A directory changed within the racy window could change again without its time changing
+        entry["mtime"] = mtime if mtime < trusted else None
+        self.directories[directory] = entry
+
+        for name in entry["files"]:
+            path = os.path.join(directory, name)
+            self.groups[kind(path)].append(path)
+        for name in entry["dirs"]:
+            listed += self.scan_directory(os.path.join(directory, name), previous, trusted)
+        return listed
+
+    # Returns every file handled by `handler`
+    def files(self, handler: str) -> list[str]:
+        return self.groups[handler]
+
+    # Returns every file, with its handler, size and modification time (as of when its directory was last listed)
+    def entries(self) -> dict[str, tuple[str, int, int]]:
+        entries = {}
+        for [directory, entry] in self.directories.items():
+            for [name, [size, mtime]] in entry["files"].items():
+                path = os.path.join(directory, name)
+                entries[path] = (kind(path), size, mtime)
+        return entries
+
+
+# Lists the files and subdirectories of a directory. Hidden files and directories are left out, like a glob does.
+def list_directory(directory: str) -> dict:
+    files = {}
+    dirs = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            try:
+                if entry.is_dir():
+                    dirs.append(entry.name)
+                elif entry.is_file():
+                    stat = entry.stat()
+                    files[entry.name] = [stat.st_size, stat.st_mtime_ns]
+            except OSError:
+                continue
+    return {"mtime": None, "files": files, "dirs": dirs}
+
+
+# Returns how a file in the project is built: function files in `data` are rendered as functions, json files
+# in `data` or `assets` go through the json builder, and everything else is copied as it is
+def kind(path: str) -> str:
+    path = os.path.normpath(path)
+    if path.startswith("data" + os.sep):
+        if path.endswith(".mcfunction"):
+            return "function"
+        if path.endswith(".json"):
+            return "json"
+    elif path.startswith("assets" + os.sep) and path.endswith(".json"):
+        return "json"
+    return "passthrough"
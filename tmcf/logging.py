@@ -1,5 +1,21 @@
 import os
+import re
 import sys
+from contextlib import contextmanager
+
+# Raised by `l.fatal` instead of exiting, while errors are being raised (see `Logging.raising`)
+class FatalError(Exception):
+    message: str
+    # Where the error happened (like `[namespace:function:line] `), if anywhere
+    ref: str | None
+
+    def __init__(self, message: str, ref: str = None):
+        super().__init__(message, ref)
+        self.message = message
+        self.ref = ref
+
+    def __str__(self):
+        return re.sub(r"\033\[\d+m", "", self.ref or "") + self.message
 
 # Class for logging & colours
 class Logging:
@@ -14,6 +30,9 @@ class Logging:
     RESET = '\033[0m'
     BOLD = '\033[1m'
 
+    # Whether `fatal` raises a `FatalError` rather than exiting
+    raise_errors = False
+
     def format(self, s: str, *codes):
         return "".join(codes) + s + self.RESET
 
@@ -23,11 +42,29 @@ class Logging:
     def print_e(self, s, *codes):
         print(self.format(s, *codes), end='')
     
-    def fatal(self, s: str, ref = None):
+    def error(self, s: str, ref = None):
         if ref:
             print(ref, end = "")
         self.print(s, self.RED)
-        sys.exit()
+
+    # `status` is the exit status, for errors that scripts and CI have to notice
+    def fatal(self, s: str, ref = None, status: int = None):
+        if self.raise_errors:
+            raise FatalError(s, ref)
+        self.error(s, ref)
+        # Flush so errors from build worker processes aren't held back in their buffers
+        sys.stdout.flush()
+        sys.exit(status)
+
+    # Raises errors as `FatalError`s within this block, for processes that keep running after a failed build
+    @contextmanager
+    def raising(self):
+        previous = self.raise_errors
+        self.raise_errors = True
+        try:
+            yield
+        finally:
+            self.raise_errors = previous
 
     def warn(self, s: str):
         self.print(s, self.YELLOW)
@@ -39,7 +76,7 @@ l = Logging()
 
 
 def function_ref(path, line_no):
-    sections = os.path.normpath(path).split("\\")
+    sections = os.path.normpath(path).split(os.sep)
     name = None
     namespace = None
     folders = ""
@@ -53,7 +90,7 @@ def function_ref(path, line_no):
     return l.format(f"[{namespace}:{folders}{name}:{line_no}] ", l.BOLD, l.RED)
 
 def generic_ref(path):
-    sections = os.path.normpath(path).split("\\")
+    sections = os.path.normpath(path).split(os.sep)
     name = None
     namespace = None
     folders = ""
@@ -1,42 +1,133 @@
+import argparse
+import os
 import sys
 import tomllib
-from typing import TypedDict
 from os.path import exists, join
 
+from tmcf import profile, variable_files
+from tmcf.config import ConfigType
 from tmcf.logging import l
+from tmcf.utils import project_path
 from tmcf.command import init
 from tmcf.command import build
+from tmcf.command import watch
+from tmcf.command import workspace
+from tmcf.command import check
+from tmcf.command import plan
 
-class ConfigType(TypedDict):
-    global_replace: dict
-    variables: dict
-    assets_out: str
-    data_out: str
+def parse_args(args: list[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="tmcf", parents=[build_options()],
+                                     description="Builds the datapack and resource pack in the current directory.")
+    parser.add_argument("--profile", type=profile_count, nargs="?", const=10, metavar="N",
+                        help="time the build and show the N slowest files and blocks (10 if no number is given)")
+    parser.add_argument("--trace", metavar="PATH",
+                        help="write a Chrome trace of the build to PATH (for chrome://tracing, Perfetto or speedscope)")
+    parser.add_argument("--plan", action="store_true",
+                        help="show how many times each loop expands and how many files and bytes the build would write, without building")
+    commands = parser.add_subparsers(dest="command")
+    init_command = commands.add_parser("init", help="create a `tmcf.toml` config, and optionally a pack template")
+    init_command.add_argument("template", nargs="?", choices=["pack"])
+    # Options can be given before the command or after it, so the command's copies only set those given after it
+    commands.add_parser("watch", parents=[build_options(command=True)], help="rebuild whenever the pack changes")
+    workspace_command = commands.add_parser("workspace", parents=[build_options(command=True)],
+                                            help="build every pack listed in `tmcf-workspace.toml`, with --jobs packs at a time")
+    workspace_command.add_argument("members", nargs="*", metavar="MEMBER", help="only build these packs")
+    check_command = commands.add_parser("check", help="find errors in every file without writing anything, exiting with status 1 if there are any")
+    check_command.add_argument("-j", "--jobs", type=int, nargs="?", default=argparse.SUPPRESS, const=os.cpu_count(),
+                               help="number of processes to check with (all cores by default)")
+
+    parsed = parser.parse_args(args)
+    if parsed.jobs is None:
+        parsed.jobs = os.cpu_count() if parsed.command == "check" else 1
+    if parsed.command and (parsed.plan or parsed.profile is not None or parsed.trace):
+        parser.error(f"--plan, --profile and --trace can't be used with `{parsed.command}`")
+    if parsed.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if parsed.profile is not None and parsed.profile < 1:
+        parser.error("--profile must be at least 1")
+    return parsed
+
+# Options shared by every command that builds the pack. A command's copy of them has no defaults (see `parse_args`).
+def build_options(command: bool = False) -> argparse.ArgumentParser:
+    options = argparse.ArgumentParser(add_help=False, argument_default=argparse.SUPPRESS if command else None)
+    options.add_argument("--incremental", action="store_true",
+                         help="only rebuild files that have changed since the last build")
+    options.add_argument("-j", "--jobs", type=int, nargs="?", const=os.cpu_count(),
+                         help="number of processes to build with (all cores if no number is given)")
+    options.add_argument("--explain", action="store_true",
+                         help="show why each file is rebuilt")
+    options.add_argument("--release", action="store_true",
+                         help="minify function and json output (like setting `release = true` in `tmcf.toml`)")
+    return options
+
+# The number given to `--profile`. It can be left out, so a command straight after it would be taken for it.
+def profile_count(value: str) -> int:
+    try:
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid number '{value}' (--profile can't be used with a command)")
 
 def main():
-    args = sys.argv
+    args = parse_args(sys.argv[1:])
 
-    if len(args) > 1 and args[1] == "init":
-        if len(args) > 2 and args[2] == "pack":
+    if args.command == "init":
+        if args.template == "pack":
             init.make_pack_folders()
         return init.init_config()
 
-    # Ensure necessary files exist
-    if not exists("./pack.mcmeta"):
+    build.explain = args.explain
+    if args.command == "workspace":
+        if not exists(workspace.WORKSPACE_FILE):
+            l.fatal("Failed to find `tmcf-workspace.toml` workspace config.")
+        return workspace.build_workspace(workspace.load_workspace(), lambda shared: load_project(args.release, shared),
+                                         args.members, args.incremental, args.jobs)
+
+    if args.command == "check":
+        return check.check(load_project, args.jobs)
+
+    config = load_project(args.release)
+
+    if args.command == "watch":
+        return watch.watch(config, lambda: validate_config(args.release), args.jobs)
+
+    if args.plan:
+        return plan.show_plan(config)
+
+    if args.profile is not None or args.trace:
+        profile.enable()
+    build.build_pack(config, incremental=args.incremental, jobs=args.jobs)
+    if args.profile is not None:
+        profile.report(args.profile)
+    if args.trace:
+        profile.write_trace(args.trace)
+
+# Checks the pack in the current directory (or `utils.project_root`) and reads its config
+def load_project(release: bool = False, shared: dict = None) -> ConfigType:
+    check_project()
+    return validate_config(release, shared)
+
+# Ensure necessary files exist
+def check_project():
+    if not exists(project_path("./pack.mcmeta")):
         l.fatal("Failed to find pack mcmeta. Run `tmcf init pack` to create.")
-    if not exists("./data"):
+    if not exists(project_path("./data")):
         l.fatal("Failed to find data directory. Run `tmcf init pack` to create.")
-    if not exists("./assets"):
+    if not exists(project_path("./assets")):
         l.fatal("Failed to find assets directory. Run `tmcf init pack` to create.")
-    if not exists("./tmcf.toml"):
+    if not exists(project_path("./tmcf.toml")):
         l.fatal("Failed to find `tmcf.toml` config file. Run `tmcf init` to create.")
 
-    config = validate_config()
-    build.build_pack(config)
-
-def validate_config() -> ConfigType:
-    with open("./tmcf.toml", "rb") as toml:
-        config = tomllib.load(toml)
+# Reads and checks `tmcf.toml`. `release` makes a release build even if the config doesn't ask for one.
+# `shared` holds the `[variables]` and `[global_replace]` tables shared by a workspace's packs, which the
+# pack's own tables add to and override.
+def validate_config(release: bool = False, shared: dict = None) -> ConfigType:
+    with open(project_path("./tmcf.toml"), "rb") as toml:
+        try:
+            config = tomllib.load(toml)
+        except tomllib.TOMLDecodeError as e:
+            l.fatal(f"Failed to parse 'tmcf.toml': {e}")
+        if shared:
+            config["variables"] = {**shared.get("variables", {}), **config.get("variables", {})}
         # Validate config
         if "data_out" not in config: l.fatal("Missing required key 'data_out' in 'tmcf.toml'")
         if "assets_out" not in config: l.fatal("Missing required key 'assets_out' in 'tmcf.toml'")
@@ -49,18 +140,84 @@ def validate_config() -> ConfigType:
                 if isinstance(val, dict):
                     l.fatal(f"Variable '{var}' in config must be a list, number, or string")
 
-        if "global_replace" in config:
-            stripped = config["global_replace"].copy()
-            stripped.pop("function", None)
-            stripped.pop("json", None)
-            config["global_replace"] = {
-                "function": {**config["global_replace"].get("function", {}), **stripped},
-                "json": {**config["global_replace"].get("json", {}), **stripped}
-            }
+        config.setdefault("variables", {})
+        config.setdefault("variable_files", {})
+        config.setdefault("global_replace", {})
+        config.setdefault("chained_replace", False)
+        config.setdefault("zip", False)
+        config.setdefault("compression_level", 6)
+        config.setdefault("release", False)
+        config.setdefault("staged", False)
+        config.setdefault("limits", {})
+
+        if not isinstance(config["chained_replace"], bool):
+            l.fatal("Key 'chained_replace' in 'tmcf.toml' must be true or false")
+        if not isinstance(config["zip"], bool):
+            l.fatal("Key 'zip' in 'tmcf.toml' must be true or false")
+        if not isinstance(config["release"], bool):
+            l.fatal("Key 'release' in 'tmcf.toml' must be true or false")
+        config["release"] = config["release"] or release
+        if not isinstance(config["staged"], bool):
+            l.fatal("Key 'staged' in 'tmcf.toml' must be true or false")
+        validate_limits(config["limits"])
+        level = config["compression_level"]
+        if not isinstance(level, int) or isinstance(level, bool) or not 0 <= level <= 9:
+            l.fatal("Key 'compression_level' in 'tmcf.toml' must be a whole number from 0 to 9")
+
+        validate_variable_files(config)
+
+        config["global_replace"] = split_replacements(config["global_replace"])
+        if shared:
+            shared_replace = split_replacements(shared.get("global_replace", {}))
+            for kind in config["global_replace"]:
+                config["global_replace"][kind] = {**shared_replace[kind], **config["global_replace"][kind]}
 
     config["data_out"] = join(config["data_out"], "tmcf_build")
     config["assets_out"] = join(config["assets_out"], "tmcf_build")
     return config
 
+# Checks the `[limits]` table, which stops builds that would be too big before they start
+def validate_limits(limits: dict):
+    if not isinstance(limits, dict):
+        l.fatal("'limits' in 'tmcf.toml' must be a table")
+    for [key, value] in limits.items():
+        if key not in plan.LIMITS:
+            l.fatal(f"Unknown limit '{key}' in 'tmcf.toml' - expected one of {', '.join(plan.LIMITS)}")
+        if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+            l.fatal(f"Limit '{key}' in 'tmcf.toml' must be a whole number of {plan.LIMITS[key]}")
+
+# Checks the `[variable_files]` table, turning each entry into a table with the file's `path` and `header` setting
+def validate_variable_files(config: ConfigType):
+    if not isinstance(config["variable_files"], dict):
+        l.fatal("'variable_files' in 'tmcf.toml' must be a table")
+    for [name, source] in config["variable_files"].items():
+        if isinstance(source, str):
+            source = {"path": source}
+        if not isinstance(source, dict) or not isinstance(source.get("path"), str):
+            l.fatal(f"Variable file '{name}' in 'tmcf.toml' must be a path, or a table with a 'path'")
+        source.setdefault("header", False)
+        if not isinstance(source["header"], bool):
+            l.fatal(f"Key 'header' of variable file '{name}' in 'tmcf.toml' must be true or false")
+
+        if name == "range":
+            l.fatal("Found reserved variable name 'range' in config.")
+        if name in config["variables"]:
+            l.fatal(f"Variable '{name}' in config is in both 'variables' and 'variable_files'")
+        if os.path.splitext(source["path"])[1] not in variable_files.FORMATS:
+            l.fatal(f"Variable file '{source['path']}' must be a {', '.join(variable_files.FORMATS[:-1])} or {variable_files.FORMATS[-1]} file")
+        if not os.path.isfile(project_path(source["path"])):
+            l.fatal(f"Failed to find variable file '{source['path']}'")
+        config["variable_files"][name] = source
+
+# Splits a `[global_replace]` table into the replacements made in function files and in json files
+def split_replacements(table: dict) -> dict[str, dict]:
+    stripped = table.copy()
+    stripped.pop("function", None)
+    stripped.pop("json", None)
+    return {
+        "function": {**table.get("function", {}), **stripped},
+        "json": {**table.get("json", {}), **stripped}
+    }
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,167 @@
+import hashlib
+import json
+import os
+
+from tmcf import index
+from tmcf.variable_files import source_stamp
+from tmcf.utils import remove, project_path
+
+MANIFEST_NAME = ".tmcf_manifest.json"
+
+# Record of what the previous build produced, stored in the build directory so that later
+# builds can skip sources that have not changed and delete outputs that are no longer made.
+# Built sources also record the variables they read and the `global_replace` strings found in their
+# output, so that changing the config only rebuilds the sources that depend on what changed.
+class Manifest:
+    # Hash of every setting in the config that affects the output, other than variables and `global_replace`
+    config_hash: str
+    # Hash of each variable's value, and of each `global_replace` string's replacement by kind of file
+    variables: dict[str, str]
+    global_replace: dict[str, dict[str, str]]
+    sources: dict[str, dict]
+    # Outputs that were produced by a previous version of a source but may not be anymore
+    stale: set[str]
+    # Sources that have to be rebuilt even though they haven't changed, with the reason why
+    invalid: dict[str, str]
+    # Why every source is being built, when there's no usable previous build
+    rebuild_reason: str | None
+    # Estimated expansions, files, bytes and largest file of each source, from the last time it was planned
+    # for the `[limits]` in `tmcf.toml` (see `tmcf.command.plan`)
+    estimates: dict[str, list]
+
+    def __init__(self, config_hash: str, sources: dict[str, dict] = None, variables: dict[str, str] = None,
+                 global_replace: dict[str, dict[str, str]] = None, rebuild_reason: str = None, estimates: dict[str, list] = None):
+        self.config_hash = config_hash
+        self.variables = variables or {}
+        self.global_replace = global_replace or {}
+        self.sources = sources or {}
+        self.stale = set()
+        self.invalid = {}
+        self.rebuild_reason = rebuild_reason
+        self.estimates = estimates or {}
+
+    @staticmethod
+    def load(build_dir: str):
+        try:
+            with open(project_path(os.path.join(build_dir, MANIFEST_NAME)), "r") as f:
+                data = json.load(f)
+            return Manifest(data["config"], data["sources"], data.get("variables"), data.get("global_replace"),
+                            estimates=data.get("estimates"))
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def save(self, build_dir: str):
+        with open(project_path(os.path.join(build_dir, MANIFEST_NAME)), "w") as f:
+            json.dump({"config": self.config_hash, "variables": self.variables, "global_replace": self.global_replace,
+                       "sources": self.sources, "estimates": {path: estimate for [path, estimate] in self.estimates.items() if path in self.sources}},
+                      f, indent=2)
+
+    # Returns why a source with the given hash has to be built, or None if it was already built by a previous run
+    def rebuild_reason_for(self, path: str, digest: str) -> str | None:
+        if path in self.invalid:
+            return self.invalid[path]
+        if path not in self.sources:
+            return self.rebuild_reason or "new file"
+        if self.sources[path]["hash"] != digest:
+            return "file changed"
+        return None
+
+    # Returns whether a source with the given hash was already built by a previous run
+    def is_current(self, path: str, digest: str) -> bool:
+        return self.rebuild_reason_for(path, digest) is None
+
+    # Records the outputs of a freshly built source, along with the variables it read and the
+    # `global_replace` strings found in its output
+    def update(self, path: str, digest: str, outputs: list[str], dependencies: dict = None):
+        if path in self.sources:
+            self.stale.update(set(self.sources[path]["outputs"]) - set(outputs))
+        self.sources[path] = {"hash": digest, "outputs": outputs, **(dependencies or {})}
+        self.invalid.pop(path, None)
+
+    # Marks the sources that depend on config values that have changed since this build as needing a rebuild,
+    # and records the new values
+    def update_config(self, config: dict):
+        variables = value_hashes(config["variables"])
+        # Variables from files change with the file, so they don't have to be loaded (or even read) to tell
+        variables.update({name: "file:" + source_stamp(source) for [name, source] in config["variable_files"].items()})
+        global_replace = {kind: value_hashes(table) for [kind, table] in config["global_replace"].items()}
+
+        changed = {name for name in self.variables.keys() | variables.keys() if self.variables.get(name) != variables.get(name)}
+        replaced = {}
+        added = {}
+        for [kind, table] in global_replace.items():
+            previous = self.global_replace.get(kind, {})
+            replaced[kind] = {key for key in previous if previous[key] != table.get(key)}
+            # A new string could be found in any file's output
+            added[kind] = sorted(table.keys() - previous.keys())
+
+        for [path, source] in self.sources.items():
+            # Copied files don't depend on the config
+            if source["hash"] is None:
+                continue
+            if "variables" not in source:
+                self.invalid[path] = "`tmcf.toml` changed"
+                continue
+            kind = index.kind(path)
+            reasons = [f"variable '{name}' changed" for name in source["variables"] if name in changed]
+            reasons += [f"global_replace '{key}' changed" for key in source["global_replace"] if key in replaced[kind]]
+            reasons += [f"global_replace '{key}' was added" for key in added[kind]]
+            if reasons:
+                self.invalid[path] = ", ".join(reasons)
+
+        self.variables = variables
+        self.global_replace = global_replace
+
+    # Moves the outputs of every source from one build folder to another (`moves` maps each old folder
+    # to its new one), for builds that were made somewhere else and then moved into place
+    def relocate(self, moves: dict[str, str]):
+        moves = {os.path.normpath(old) + os.sep: os.path.normpath(new) + os.sep for [old, new] in moves.items()}
+        for source in self.sources.values():
+            source["outputs"] = [relocated(output, moves) for output in source["outputs"]]
+
+    # Forgets a source that no longer exists, marking its outputs as stale
+    def forget(self, path: str):
+        if path in self.sources:
+            self.stale.update(self.sources.pop(path)["outputs"])
+
+    # Forgets every source that is not in `paths`
+    def retain(self, paths: list[str]):
+        keep = set(paths)
+        for path in [p for p in self.sources if p not in keep]:
+            self.forget(path)
+
+    # Deletes stale outputs that no remaining source still produces, returning how many were deleted.
+    # Emptied directories are removed up to whichever of `roots` the output is in
+    def delete_stale(self, roots: list[str]) -> int:
+        owned = {output for source in self.sources.values() for output in source["outputs"]}
+        deleted = 0
+        for output in sorted(self.stale - owned):
+            root = next((root for root in roots if os.path.normpath(output).startswith(os.path.normpath(root) + os.sep)), roots[0])
+            if remove(output, root):
+                deleted += 1
+        self.stale.clear()
+        return deleted
+
+
+# Returns where an output ends up once its build folder is moved
+def relocated(output: str, moves: dict[str, str]) -> str:
+    for [old, new] in moves.items():
+        if output.startswith(old):
+            return new + output[len(old):]
+    return output
+
+# Settings that don't change what any file builds to: how the build is written (`staged`) and checked (`limits`)
+UNHASHED_SETTINGS = ("staged", "limits")
+
+# Hashes the settings in the config that every file depends on (everything but variables, `global_replace`
+# and `UNHASHED_SETTINGS`)
+def config_hash(config: dict) -> str:
+    settings = {key: value for [key, value] in config.items()
+                if key not in ("variables", "variable_files", "global_replace") + UNHASHED_SETTINGS}
+    return hash_value(settings)
+
+def value_hashes(values: dict) -> dict[str, str]:
+    return {name: hash_value(value) for [name, value] in values.items()}
+
+def hash_value(value) -> str:
+    return hashlib.sha256(json.dumps(value, sort_keys=True).encode()).hexdigest()
@@ -0,0 +1,56 @@
+import json
+
+# Comments that are kept in release builds, since tools read them (like the `#>` documentation comments
+# and `#define`, `#declare` and `#alias` annotations read by Spyglass and Datapack Helper Plus)
+KEPT_COMMENTS = ("#>", "#!", "#define ", "#declare ", "#alias ", "#region", "#endregion")
+
+# Strips comments, blank lines and indentation from a function file as it's written, for release builds.
+# Minecraft trims every line and skips blank lines and comments itself, so the function runs the same.
+# A line ending in `\` carries on onto the next line, so the lines it runs into are always kept (even when
+# blank, since that ends the command), or dropped along with it if it's a comment.
+class Minifier:
+    # Bytes given and bytes kept
+    before: int
+    after: int
+
+    def __init__(self):
+        # The end of the text given so far, if it didn't end with a full line
+        self.partial = ""
+        # Whether the last line ended in `\`, and whether the line it belongs to is being dropped
+        self.continued = False
+        self.dropping = False
+        self.before = 0
+        self.after = 0
+
+    def feed(self, text: str) -> str:
+        lines = (self.partial + text).split("\n")
+        self.partial = lines.pop()
+        self.before += len(text.encode())
+        return self.keep(self.minify(lines), "\n")
+
+    # Returns what is left of the last line once there's nothing more to write
+    def finish(self) -> str:
+        partial = self.partial
+        self.partial = ""
+        return self.keep(self.minify([partial]), "") if partial else ""
+
+    def keep(self, lines: list[str], end: str) -> str:
+        text = "\n".join(lines) + end if lines else ""
+        self.after += len(text.encode())
+        return text
+
+    def minify(self, lines: list[str]) -> list[str]:
+        kept = []
+        for line in lines:
+            stripped = line.strip()
+            if not self.continued:
+                self.dropping = not stripped or (stripped[0] == "#" and not stripped.startswith(KEPT_COMMENTS))
+            self.continued = stripped.endswith("\\")
+            if not self.dropping:
+                kept.append(stripped)
+        return kept
+
+
+# Returns a json file's text, without any whitespace between values
+def compact_json(j) -> str:
+    return json.dumps(j, separators=(",", ":"))
@@ -0,0 +1,164 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+from tmcf.logging import l
+
+# Build profiling, for `--profile` and `--trace`. Everything here does nothing unless `enable` has been called,
+# so the build only pays for a few checks of `active` when it isn't being profiled.
+
+active = False
+# When the build started, which trace timestamps are relative to
+start = 0.0
+# Wall time of each phase of the build
+phases: dict[str, float] = {}
+# Times and sizes recorded outside of any source file (like copying files, or writing zips)
+totals: dict[str, float] = {}
+# Records of the source files built so far
+sources: list[dict] = []
+# Record of the source file currently being built by this process
+current: dict | None = None
+# Chrome trace events recorded outside of any source file
+events: list[dict] = []
+# Most block events traced for a single source file, since nested loops can run their inner blocks a huge number of times
+TRACE_BLOCK_LIMIT = 10000
+
+
+def enable(started: float = None):
+    global active, start
+    active = True
+    start = time.perf_counter() if started is None else started
+
+
+def trace_event(name: str, category: str, began: float, ended: float, args: dict = None) -> dict:
+    event = {"name": name, "cat": category, "ph": "X", "pid": os.getpid(), "tid": 0,
+             "ts": (began - start) * 1e6, "dur": (ended - began) * 1e6}
+    if args:
+        event["args"] = args
+    return event
+
+
+# Times a phase of the build
+@contextmanager
+def phase(name: str):
+    if not active:
+        yield
+        return
+    began = time.perf_counter()
+    try:
+        yield
+    finally:
+        ended = time.perf_counter()
+        phases[name] = phases.get(name, 0) + ended - began
+        events.append(trace_event(name, "phase", began, ended))
+
+
+def begin_source(path: str, kind: str):
+    global current
+    if active:
+        current = {"path": os.path.normpath(path), "kind": kind, "start": time.perf_counter(), "duration": 0,
+                   "parse": 0, "replace": 0, "write": 0, "bytes": 0, "files": 0, "blocks": {}, "events": []}
+
+def end_source(files: int):
+    global current
+    if current is None:
+        return
+    ended = time.perf_counter()
+    current["duration"] = ended - current["start"]
+    current["files"] = files
+    current["events"].insert(0, trace_event(current["path"], current["kind"], current["start"], ended, {
+        "parse_ms": current["parse"] * 1000, "replace_ms": current["replace"] * 1000,
+        "bytes": current["bytes"], "files": files}))
+    sources.append(current)
+    current = None
+
+# Removes and returns the records of the source files built so far, for build workers to hand back
+def take() -> list[dict]:
+    records = sources.copy()
+    sources.clear()
+    return records
+
+
+# Adds to a time or size, for the current source file if there is one
+def add(field: str, amount: float):
+    if current is not None:
+        current[field] += amount
+    else:
+        totals[field] = totals.get(field, 0) + amount
+
+@contextmanager
+def timer(field: str):
+    if not active:
+        yield
+        return
+    began = time.perf_counter()
+    try:
+        yield
+    finally:
+        add(field, time.perf_counter() - began)
+
+
+# Records the time spent in a block under `name` in the current source file
+@contextmanager
+def span(name: str):
+    if current is None:
+        yield
+        return
+    record = block_record(name)
+    began = time.perf_counter()
+    try:
+        yield
+    finally:
+        ended = time.perf_counter()
+        record["time"] += ended - began
+        if len(current["events"]) < TRACE_BLOCK_LIMIT:
+            current["events"].append(trace_event(name, "block", began, ended))
+
+# Passes through the chunks rendered by a block, recording the time from the first chunk being asked for
+# to the last (which includes writing them out)
+def block(chunks: Iterator[str], name: str) -> Iterator[str]:
+    with span(name):
+        yield from chunks
+
+# Counts the number of times a block has repeated its contents (loop items, or generated files)
+def expansions(name: str, count: int):
+    if current is not None:
+        block_record(name)["expansions"] += count
+
+def block_record(name: str) -> dict:
+    return current["blocks"].setdefault(name, {"time": 0, "expansions": 0})
+
+
+def report(top: int):
+    ms = lambda seconds: f"{seconds * 1000:.1f}ms"
+    total = lambda field: totals.get(field, 0) + sum(record[field] for record in sources)
+    kinds = {}
+    for record in sources:
+        kinds.setdefault(record["kind"], []).append(record["duration"])
+
+    l.print("Profile:", l.BOLD)
+    l.print("  Phases: " + ", ".join(f"{name} {ms(seconds)}" for name, seconds in phases.items()))
+    l.print("  Totals: " + ", ".join(f"{kind} {ms(sum(times))} ({len(times)} file(s))" for kind, times in kinds.items())
+            + f", parsing {ms(total('parse'))}, replacing {ms(total('replace'))}, writing {ms(total('write'))}"
+            + f", {total('bytes') / 1024:.1f} KB in {int(total('files'))} file(s)")
+
+    l.print(f"  Slowest files:")
+    for record in sorted(sources, key=lambda record: record["duration"], reverse=True)[:top]:
+        l.print(f"    {ms(record['duration']):>10}  {record['path']}  (parse {ms(record['parse'])}, replace {ms(record['replace'])}, "
+                f"{record['files']} file(s), {record['bytes'] / 1024:.1f} KB)")
+
+    blocks = [(record["path"], name, block) for record in sources for name, block in record["blocks"].items()]
+    if blocks:
+        l.print(f"  Slowest blocks:")
+    for [path, name, block] in sorted(blocks, key=lambda entry: entry[2]["time"], reverse=True)[:top]:
+        l.print(f"    {ms(block['time']):>10}  {path} {name}  ({block['expansions']} expansion(s))")
+
+
+# Writes everything recorded as a Chrome trace, which can be opened in `chrome://tracing`, Perfetto or speedscope
+def write_trace(path: str):
+    trace = events + [event for record in sources for event in record["events"]]
+    with open(path, "w") as f:
+        json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
+    l.print(f"Wrote trace to {path}")
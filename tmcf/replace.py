@@ -0,0 +1,161 @@
+import re
+from functools import lru_cache
+
+# Up to this many names, it's quicker to check which names are in the text before searching for them together
+PREFILTER_LIMIT = 16
+
+# Replaces a set of substrings ("names") with values, in a single pass over the text.
+# Compiled once per set of names (a loop's variables, or a `global_replace` table) and then
+# applied to every expansion, instead of running one `str.replace` per name.
+class Substitution:
+    names: tuple[str, ...]
+    # Matches any of the names (longest first, so that `id` wins over `i`), captured so the text can be split on it
+    pattern: re.Pattern | None
+    # The only name, when there is just one and a plain `str.replace` is all that's needed
+    single: str | None
+
+    def __init__(self, names: tuple[str, ...]):
+        self.names = names
+        self.single = None
+        self.pattern = None
+
+        unique = sorted({name for name in names if name}, key=len, reverse=True)
+        if len(unique) == 1:
+            self.single = unique[0]
+        elif unique:
+            self.pattern = re.compile("(" + "|".join(re.escape(name) for name in unique) + ")")
+
+    # Maps each name to its value as a string. The first occurrence of a repeated name wins,
+    # as it did with chained replacements
+    def lookup(self, values) -> dict[str, str]:
+        lookup = {}
+        for [name, value] in zip(self.names, values):
+            if name not in lookup:
+                lookup[name] = str(value)
+        return lookup
+
+    # Replaces each name in `s` with the value at the same position in `values`.
+    # `chained` runs the replacements one after another instead, so values can be replaced by later names.
+    # The names that were found in the text are added to `found`, if given.
+    def apply(self, s: str, values, chained: bool = False, found: set[str] = None) -> str:
+        if chained:
+            for [name, value] in zip(self.names, values):
+                if found is not None and name and name in s:
+                    found.add(name)
+                s = s.replace(name, str(value))
+            return s
+
+        if self.single is not None:
+            if found is not None and self.single in s:
+                found.add(self.single)
+            return s.replace(self.single, str(values[self.names.index(self.single)]))
+        if self.pattern is None:
+            return s
+
+        lookup = self.lookup(values)
+        if len(lookup) <= PREFILTER_LIMIT:
+            present = [name for name in lookup if name in s]
+            if found is not None:
+                found.update(present)
+            if not present:
+                return s
+            if len(present) == 1:
+                return s.replace(present[0], lookup[present[0]])
+
+        parts = self.pattern.split(s)
+        if found is not None:
+            found.update(parts[1::2])
+        parts[1::2] = map(lookup.__getitem__, parts[1::2])
+        return "".join(parts)
+
+    # Splits `text` on the names ahead of time, for text that is substituted once per loop item
+    def plan(self, text: str) -> "Plan":
+        return Plan(self, text)
+
+
+# Text that has already been split into literal parts and the names between them, so that
+# rendering it for each set of values is a join rather than another search of the text
+class Plan:
+    substitution: Substitution
+    text: str
+    # The text between the names
+    literals: list[str]
+    # For each name found in the text, the position of its value
+    indices: list[int]
+    # The position of the only value used, when every name found is the same (so rendering is a single join)
+    single_index: int | None
+
+    def __init__(self, substitution: Substitution, text: str):
+        self.substitution = substitution
+        self.text = text
+        names = substitution.names
+        if substitution.single is not None:
+            self.literals = text.split(substitution.single)
+            self.indices = [names.index(substitution.single)] * (len(self.literals) - 1)
+        elif substitution.pattern is not None:
+            parts = substitution.pattern.split(text)
+            self.literals = parts[0::2]
+            self.indices = [names.index(name) for name in parts[1::2]]
+        else:
+            self.literals = [text]
+            self.indices = []
+        self.find_single_index()
+
+    def find_single_index(self):
+        self.single_index = self.indices[0] if self.indices and len(set(self.indices)) == 1 else None
+
+    def render(self, values, chained: bool = False) -> str:
+        if chained:
+            return self.substitution.apply(self.text, values, True)
+        if not self.indices:
+            return self.literals[0]
+        if self.single_index is not None:
+            return str(values[self.single_index]).join(self.literals)
+
+        strings = [str(value) for value in values]
+        parts = [None] * (len(self.literals) + len(self.indices))
+        parts[0::2] = self.literals
+        parts[1::2] = map(strings.__getitem__, self.indices)
+        return "".join(parts)
+
+    # Fills in the values from position `count` onwards (an enclosing loop's values), returning a plan
+    # that only takes the first `count` values. The text is still only substituted once.
+    def bind(self, values, count: int) -> "Plan":
+        bound = Plan.__new__(Plan)
+        bound.substitution = self.substitution
+        bound.text = self.text
+        bound.literals = [self.literals[0]]
+        bound.indices = []
+        for [index, literal] in zip(self.indices, self.literals[1:]):
+            if index >= count:
+                bound.literals[-1] += str(values[index - count]) + literal
+            else:
+                bound.indices.append(index)
+                bound.literals.append(literal)
+        bound.find_single_index()
+        return bound
+
+    # Fills in the first `count` values once for each of `items` (a loop's values), joining the results
+    # with `separator`, and returns a plan for the remaining values (the enclosing loops' values)
+    def expand(self, items, count: int, separator: str = "\n") -> "Plan":
+        expanded = Plan.__new__(Plan)
+        expanded.substitution = self.substitution
+        expanded.text = self.text
+        expanded.literals = [""]
+        expanded.indices = []
+        for [i, item] in enumerate(items):
+            expanded.literals[-1] += (separator if i else "") + self.literals[0]
+            for [index, literal] in zip(self.indices, self.literals[1:]):
+                if index < count:
+                    expanded.literals[-1] += str(item[index]) + literal
+                else:
+                    expanded.indices.append(index - count)
+                    expanded.literals.append(literal)
+        expanded.find_single_index()
+        return expanded
+
+
+# Returns the compiled substitution for a set of names, compiling it only the first time it's seen
+@lru_cache(maxsize=4096)
+def substitution(names: tuple[str, ...]) -> Substitution:
+    return Substitution(names)
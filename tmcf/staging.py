@@ -0,0 +1,128 @@
+import ctypes
+import os
+import shutil
+import sys
+import threading
+import time
+
+from tmcf.utils import project_path
+
+# Folder that packs are built in before being swapped in, next to each pack (in the datapacks or resourcepacks
+# folder). Minecraft only loads the folders and zips directly inside those, so it never sees a pack in here.
+STAGING_DIR = ".tmcf_staging"
+# Part of the name given to previous builds once they've been swapped out, before they're deleted
+OLD_MARKER = ".old."
+# `renameat2` flag that swaps two paths in a single step (Linux 3.15 and later), and the directory it takes to
+# mean the working directory
+RENAME_EXCHANGE = 2
+AT_FDCWD = -100
+
+# libc's `renameat2`, once it's been looked up (False if there isn't one)
+renameat2 = None
+
+# Returns where the pack at `out` (a folder, or a zip if it ends with `.zip`) is built before being swapped in
+def staging_path(out: str) -> str:
+    return os.path.join(staging_folder(out), os.path.basename(os.path.normpath(out)))
+
+# Returns the staging folder for a pack, or for something already in it
+def staging_folder(path: str) -> str:
+    parent = os.path.dirname(os.path.normpath(path))
+    return parent if os.path.basename(parent) == STAGING_DIR else os.path.join(parent, STAGING_DIR)
+
+# Returns where a staged pack is swapped in to
+def published_path(staged: str) -> str:
+    staged = os.path.normpath(staged)
+    parent = os.path.dirname(staged)
+    if os.path.basename(parent) != STAGING_DIR:
+        return staged
+    return os.path.join(os.path.dirname(parent), os.path.basename(staged))
+
+# Gets the staging folder ready to build the pack at `out` in, moving anything left there by a build that
+# failed or was stopped out of the way
+def prepare(out: str):
+    out = project_path(out)
+    discard(staging_path(out))
+    discard(staging_path(out + ".zip"))
+
+# Swaps the staged build of the pack at `out` in for the previous one, so the pack is never half written.
+# Folders are exchanged in a single step where the system can (see `exchange`), and zips replace each other
+# in one rename, so the pack is never missing. Elsewhere the previous folder is renamed out of the way and the
+# new one renamed into its place, so it's only missing for the instant between the two renames. A previous
+# build in the other form (a folder instead of a zip, or the other way around) is moved away too.
+def swap(out: str, zipped: bool):
+    out = os.path.normpath(project_path(out))
+    if zipped:
+        discard(out)
+        os.replace(staging_path(out + ".zip"), out + ".zip")
+        return
+
+    discard(out + ".zip")
+    staged = staging_path(out)
+    if os.path.lexists(out) and exchange(staged, out):
+        # The previous build is now where the new one was built
+        discard(staged)
+        return
+    discard(out)
+    os.rename(staged, out)
+
+# Swaps two paths in a single step, returning False if the system or filesystem can't
+def exchange(a: str, b: str) -> bool:
+    global renameat2
+    if renameat2 is None:
+        renameat2 = find_renameat2()
+    if not renameat2:
+        return False
+    return renameat2(AT_FDCWD, os.fsencode(a), AT_FDCWD, os.fsencode(b), RENAME_EXCHANGE) == 0
+
+def find_renameat2():
+    if not sys.platform.startswith("linux"):
+        return False
+    try:
+        function = ctypes.CDLL(None, use_errno=True).renameat2
+    except (OSError, AttributeError):
+        # Older C libraries don't have it
+        return False
+    function.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint]
+    function.restype = ctypes.c_int
+    return function
+
+# Moves a previous build out of the way to be deleted later, if there is one
+def discard(path: str):
+    if not os.path.lexists(path):
+        return
+    folder = staging_folder(path)
+    os.makedirs(folder, exist_ok=True)
+    old = os.path.join(folder, f"{os.path.basename(os.path.normpath(path))}{OLD_MARKER}{time.time_ns()}")
+    os.rename(path, old)
+
+
+# Deletes the previous builds of the packs at `outs` on a background thread, so the new pack is in place without
+# waiting for it. Builds that are still left (because tmcf was stopped first) are deleted by the next one.
+def delete_old(outs: list[str]) -> threading.Thread:
+    # The paths are made absolute first, as the working directory could change while it runs
+    thread = threading.Thread(target=delete_old_now, args=([os.path.abspath(project_path(out)) for out in outs],))
+    thread.start()
+    return thread
+
+def delete_old_now(outs: list[str]):
+    for folder in {staging_folder(out) for out in outs}:
+        try:
+            names = os.listdir(folder)
+        except FileNotFoundError:
+            continue
+        for name in names:
+            if OLD_MARKER not in name:
+                continue
+            path = os.path.join(folder, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        # Only removed once nothing is being built in it
+        try:
+            os.rmdir(folder)
+        except OSError:
+            pass
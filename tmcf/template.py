@@ -0,0 +1,330 @@
+import json
+import os
+import re
+
+from tmcf.logging import l, function_ref
+from tmcf.replace import substitution, Plan
+from tmcf.utils import Consumable, project_path
+
+# Bump whenever the node classes change, so stale caches are thrown away instead of loaded
+CACHE_VERSION = 2
+CACHE_PATH = "./.tmcf/templates.json"
+# Where the cache was kept when it was pickled, deleted once it's been replaced
+OLD_CACHE_PATH = "./.tmcf/templates.pickle"
+BLOCK_KINDS = ("for", "using", "generate")
+# Characters that have to be escaped inside JSON strings
+JSON_ESCAPED = re.compile(r'[\x00-\x1f"\\]')
+# Characters that can appear in JSON text between values, or that have to be escaped inside strings
+JSON_STRUCTURE = re.compile(r'[\x00-\x1f\s"\\,:\[\]{}]')
+
+# A compiled function file is a list of nodes: runs of plain lines (`Text`) and `#@` blocks (`Block`).
+# Compiling only depends on the source text, so trees can be cached by the source's hash and rendered
+# again with a different config.
+
+# A run of consecutive plain lines, split ahead of time on every variable in scope
+class Text:
+    lines: list[str]
+    plan: Plan
+
+    def __init__(self, lines: list[str]):
+        self.lines = lines
+        self.plan = None
+
+    def leads_with_hash(self) -> bool:
+        return self.lines[0].startswith("#")
+
+
+# A `#@ for`, `#@ using` or `#@ generate` block
+class Block:
+    kind: str
+    # Tokens of the opening `#@` line
+    tokens: list[str]
+    # Line number of the opening `#@` line, for errors
+    line_no: int
+    children: list
+    # Whether to drop the first character of this block's output, because it is inside a commented-out block
+    strip_first: bool
+
+    def __init__(self, kind: str, tokens: list[str], line_no: int, children: list):
+        self.kind = kind
+        self.tokens = tokens
+        self.line_no = line_no
+        self.children = children
+        self.strip_first = False
+
+    # The names of the variables this block defines
+    def names(self) -> tuple[str, ...]:
+        index = {"for": 2, "using": 2, "generate": 4}[self.kind]
+        return tuple(self.tokens[index].split(",")) if len(self.tokens) > index else ()
+
+    def leads_with_hash(self) -> bool:
+        return self.kind != "generate" and len(self.children) > 0 and self.children[0].leads_with_hash()
+
+
+def compile_function(lines: list[str], path: str) -> list:
+    nodes = parse_nodes(Consumable(lines), path)
+    strip_comments(nodes)
+    make_plans(nodes, ())
+    return nodes
+
+
+# Reads nodes until the end of the file, or until the closing `#@` of the block starting on `block_line`
+def parse_nodes(lines: Consumable, path: str, block_line: int = None) -> list:
+    nodes = []
+    while True:
+        if not lines.is_consumable():
+            if block_line is not None:
+                l.fatal("Missing closing '#@' for tmcf block", function_ref(path, block_line))
+            return nodes
+
+        line = lines.consume().strip()
+        if block_line is not None and line == "#@":
+            return nodes
+
+        if not line.startswith("#@"):
+            if nodes and isinstance(nodes[-1], Text):
+                nodes[-1].lines.append(line)
+            else:
+                nodes.append(Text([line]))
+            continue
+
+        tokens = line.split(" ")
+        if not len(tokens) > 1:
+            l.fatal(f"Missing token after tmcf comment - expected 'for', 'generate', or 'using'", function_ref(path, lines.index))
+
+        match tokens[1]:
+            case "for" | "generate" | "using" as kind:
+                line_no = lines.index
+                nodes.append(Block(kind, tokens, line_no, parse_nodes(lines, path, line_no)))
+            case _ as t:
+                l.fatal(f"Unexpected token '{t}' in tmcf comment - expected 'for', 'generate', or 'using'", function_ref(path, lines.index))
+
+
+# Blocks whose lines are all commented out (so that IDEs don't complain about them) have the comments removed
+def strip_comments(nodes: list):
+    for node in nodes:
+        if not isinstance(node, Block):
+            continue
+
+        strip_comments(node.children)
+        if node.kind == "using" or not all(commented(child) for child in node.children):
+            continue
+
+        for child in node.children:
+            if isinstance(child, Text):
+                child.lines = [line[1:] for line in child.lines]
+            else:
+                child.strip_first = True
+
+def commented(node) -> bool:
+    if isinstance(node, Text):
+        return all(line.startswith("#") for line in node.lines)
+    return node.leads_with_hash()
+
+
+# Splits every run of text on the variables in scope, innermost first so that inner variables shadow outer ones.
+# Generated files only see their own variables.
+def make_plans(nodes: list, names: tuple[str, ...]):
+    for node in nodes:
+        if isinstance(node, Text):
+            node.plan = substitution(names).plan("\n".join(node.lines))
+        else:
+            make_plans(node.children, node.names() + (names if node.kind != "generate" else ()))
+
+
+# Returns every `generate` block in the tree, inner blocks before the blocks that contain them
+def generate_blocks(nodes: list) -> list[Block]:
+    blocks = []
+    for node in nodes:
+        if isinstance(node, Block):
+            blocks += generate_blocks(node.children)
+            if node.kind == "generate":
+                blocks.append(node)
+    return blocks
+
+
+# A JSON object repeated by a `for` or `using` is compiled into a tree of nodes mirroring it, with the variables'
+# positions in its keys, strings and numbers worked out ahead of time. Each copy is then built directly from the
+# tree instead of dumping, replacing and re-parsing the whole object. Every node renders from the values both as
+# they are and as strings.
+
+# A dict or list is copied from `template`, which holds its constant strings and values, and then has its other
+# items rendered into their places (`parts`, each a key or index and its node), keeping their order
+class JsonDict:
+    template: dict
+    parts: list[tuple]
+
+    def __init__(self, entries: list[tuple]):
+        self.template = {key.value: value.value if isinstance(value, JsonConstant) else None for [key, value] in entries}
+        self.parts = [(key.value, value) for [key, value] in entries if not isinstance(value, JsonConstant)]
+
+    def render(self, values, strings) -> dict:
+        copy = self.template.copy()
+        for [key, node] in self.parts:
+            copy[key] = node.render(values, strings)
+        return copy
+
+
+# A dict with variables in its keys, which renders every entry
+class JsonKeyedDict:
+    entries: list[tuple]
+
+    def __init__(self, entries: list[tuple]):
+        self.entries = entries
+
+    def render(self, values, strings) -> dict:
+        return {key.render(values, strings): value.render(values, strings) for [key, value] in self.entries}
+
+
+class JsonList:
+    template: list
+    parts: list[tuple]
+
+    def __init__(self, items: list):
+        self.template = [item.value if isinstance(item, JsonConstant) else None for item in items]
+        self.parts = [(i, item) for [i, item] in enumerate(items) if not isinstance(item, JsonConstant)]
+
+    def render(self, values, strings) -> list:
+        copy = self.template.copy()
+        for [i, node] in self.parts:
+            copy[i] = node.render(values, strings)
+        return copy
+
+
+# A string, number, `true`, `false` or `null` without any variables in it
+class JsonConstant:
+    def __init__(self, value):
+        self.value = value
+
+    def render(self, values, strings):
+        return self.value
+
+
+# A string with variables in it
+class JsonString:
+    plan: Plan
+    chained: bool
+
+    def __init__(self, plan: Plan, chained: bool):
+        self.plan = plan
+        self.chained = chained
+        # The plan's parts, to join straight from the strings of the values
+        self.parts = [(index, literal) for [index, literal] in zip(plan.indices, plan.literals[1:])]
+
+    def render(self, values, strings) -> str:
+        if self.chained:
+            return self.plan.render(values, True)
+        if self.plan.single_index is not None:
+            return strings[self.plan.single_index].join(self.plan.literals)
+        text = self.plan.literals[0]
+        for [index, literal] in self.parts:
+            text += strings[index] + literal
+        return text
+
+
+# A number, `true`, `false` or `null` with variables in it, which is parsed again after replacing like the text would be
+class JsonValue(JsonString):
+    def render(self, values, strings):
+        return json.loads(JsonString.render(self, values, strings))
+
+
+# Returns the tree building copies of `object`, or None if replacing `names` in its text could do
+# more than replace text inside its strings and values (like matching an escape sequence or the `:` between a key and its value).
+# Rendering raises `json.JSONDecodeError` if a value doesn't parse on its own (like `1, 2` replacing a number), since
+# that needs the whole text parsed.
+def compile_json(object, names: tuple[str, ...], chained: bool = False):
+    # Names that can't span the structure between values can only match inside a single value
+    if not all(name and JSON_STRUCTURE.search(name) is None for name in names):
+        return None
+
+    sub = substitution(names)
+    plans = []
+    try:
+        root = json_node(object, sub, chained, plans)
+    except RecursionError:
+        # Too deeply nested to compile
+        return None
+
+    # Strings without escapes and other values appear in the text exactly as they are, so if they
+    # hold every match in the text, escaped strings don't contain any
+    if len(sub.plan(json.dumps(object)).indices) != sum(len(plan.indices) for plan in plans):
+        return None
+    return root
+
+# Returns the node building `value`, adding the plan of every string or value containing variables to `plans`
+def json_node(value, sub, chained: bool, plans: list):
+    if isinstance(value, dict):
+        entries = [(json_node(key, sub, chained, plans), json_node(item, sub, chained, plans)) for [key, item] in value.items()]
+        return JsonDict(entries) if all(isinstance(key, JsonConstant) for [key, _] in entries) else JsonKeyedDict(entries)
+    if isinstance(value, list):
+        return JsonList([json_node(item, sub, chained, plans) for item in value])
+
+    if isinstance(value, str):
+        # Strings that are escaped in the text can't be matched inside, so they're constant
+        if value.isascii() and json_safe(value):
+            plan = sub.plan(value)
+            if plan.indices:
+                plans.append(plan)
+                return JsonString(plan, chained)
+    else:
+        plan = sub.plan(json.dumps(value))
+        if plan.indices:
+            plans.append(plan)
+            return JsonValue(plan, chained)
+
+    return JsonConstant(value)
+
+
+# Whether `s` can be put inside a JSON string as is, without changing what the string means
+def json_safe(s: str) -> bool:
+    return JSON_ESCAPED.search(s) is None
+
+
+# The cache holds each tree as plain json data (see `encode`), so a cache that was tampered with can at worst fail
+# to load, never run anything. Only the parsed tree is kept; plans are quick to make again.
+def load_cache() -> dict[str, list]:
+    try:
+        with open(project_path(CACHE_PATH), "rb") as f:
+            cache = json.load(f)
+        if cache["version"] != CACHE_VERSION:
+            return {}
+        return {digest: load_template(nodes) for [digest, nodes] in cache["templates"].items()}
+    except (OSError, ValueError, KeyError, TypeError, AttributeError, RecursionError):
+        return {}
+
+def save_cache(templates: dict[str, list]):
+    os.makedirs(os.path.dirname(project_path(CACHE_PATH)), exist_ok=True)
+    with open(project_path(CACHE_PATH), "w") as f:
+        json.dump({"version": CACHE_VERSION, "templates": {digest: encode(nodes) for [digest, nodes] in templates.items()}}, f, separators=(",", ":"))
+    if os.path.exists(project_path(OLD_CACHE_PATH)):
+        os.remove(project_path(OLD_CACHE_PATH))
+
+def load_template(data: list) -> list:
+    nodes = decode(data)
+    make_plans(nodes, ())
+    return nodes
+
+# Returns a tree as json data
+def encode(nodes: list) -> list:
+    return [{"lines": node.lines} if isinstance(node, Text) else
+            {"kind": node.kind, "tokens": node.tokens, "line_no": node.line_no, "strip_first": node.strip_first, "children": encode(node.children)}
+            for node in nodes]
+
+# Returns the tree (without plans) that `encode` turned into `data`, raising ValueError if it isn't one
+def decode(data: list) -> list:
+    nodes = []
+    for item in data:
+        if "lines" in item:
+            nodes.append(Text(strings(item["lines"])))
+            continue
+        if item["kind"] not in BLOCK_KINDS or type(item["line_no"]) is not int or type(item["strip_first"]) is not bool:
+            raise ValueError("Not a template")
+        block = Block(item["kind"], strings(item["tokens"]), item["line_no"], decode(item["children"]))
+        block.strip_first = item["strip_first"]
+        nodes.append(block)
+    return nodes
+
+def strings(value) -> list[str]:
+    if not isinstance(value, list) or not all(isinstance(s, str) for s in value):
+        raise ValueError("Not a template")
+    return value
@@ -1,12 +1,537 @@
+import hashlib
 import os
+import queue
+import shutil
+import tempfile
+import threading
+import zipfile
+from typing import Iterable, Iterator
 
-# Writes to a file, creating its directories if they are not present
-def write(path: str, contents: str):
-    os.makedirs(os.path.dirname(os.path.normpath(path)), exist_ok=True)
-    with open(path, "w") as f:
+from tmcf import profile
+
+# The folder of the project being built. Paths in the build stay relative to the project (like
+# `./data/ns/function/tick.mcfunction`), and are only resolved against this when files are opened, so a project
+# can be built without changing the working directory (see `tmcf.builder`).
+project_root = "."
+
+# Returns where a path in the project is, from the working directory
+def project_path(path: str) -> str:
+    if project_root == ".":
+        return path
+    return os.path.join(project_root, path)
+
+
+# Whether files are thrown away instead of written, for checking a project without building it (`tmcf check`)
+discard_writes = False
+
+# Writes to a file, creating its directories if they are not present. While writes are being made in
+# the background, this only queues the write; `ref` is shown if it fails.
+def write(path: str, contents: str, ref: str = None):
+    if discard_writes:
+        return
+    path = os.path.normpath(path)
+    if profile.active:
+        profile.add("bytes", len(contents))
+    with profile.timer("write"):
+        if archive := archive_for(path):
+            return archive.add(path, contents)
+        if write_queue:
+            return write_queue.put(path, ref, write_file, path, contents)
+        write_file(path, contents)
+
+def write_file(path: str, contents: str):
+    make_dirs(os.path.dirname(path))
+    with open(project_path(path), "w", encoding="utf-8") as f:
         f.write(contents)
 
 
+# Directories that have been created in the build, so that writing many files into the same directory
+# only creates it once. Forgotten whenever directories in the build are deleted.
+made_dirs: set[str] = set()
+
+def make_dirs(directory: str):
+    directory = project_path(directory)
+    if directory not in made_dirs:
+        os.makedirs(directory, exist_ok=True)
+        made_dirs.add(directory)
+
+
+# How many threads write files in the background. Building keeps a core busy, so this is one per spare core
+# (and none on a single core, where files are written as they're built)
+WRITE_THREADS = min(4, (os.cpu_count() or 1) - 1)
+# How many writes each thread can have waiting before building waits for it to catch up
+WRITE_QUEUE_SIZE = 64
+
+# Writes files on background threads, so that building can carry on while files are written.
+# Each file is always written by the same thread, so writes to it happen in the order they were queued.
+# With no threads, files are written straight away. Either way, failed writes are collected to be reported together.
+# Errors other than `OSError` are bugs rather than files that couldn't be written, so they're raised when the queue
+# is drained instead.
+class WriteQueue:
+    queues: list[queue.Queue]
+    # The path, ref and error of every write that failed
+    errors: list[tuple[str, str, Exception]]
+
+    def __init__(self, threads: int):
+        self.queues = [queue.Queue(WRITE_QUEUE_SIZE) for _ in range(threads)]
+        self.errors = []
+        for q in self.queues:
+            threading.Thread(target=self.run, args=(q,), daemon=True).start()
+
+    # Queues a call of `function` with `args`, which writes to `path`
+    def put(self, path: str, ref: str, function, *args):
+        if not self.queues:
+            return self.call(path, ref, function, args)
+        self.queues[hash(path) % len(self.queues)].put((path, ref, function, args))
+
+    def call(self, path: str, ref: str, function, args: tuple):
+        try:
+            function(*args)
+        except Exception as e:
+            self.errors.append((path, ref, e))
+
+    def run(self, q: queue.Queue):
+        while True:
+            task = q.get()
+            try:
+                if task is None:
+                    return
+                self.call(*task)
+            finally:
+                # Always marked done, or draining would wait for it forever
+                q.task_done()
+
+    # Waits for every queued write to finish, returning the ones that failed since the last drain
+    def drain(self) -> list[tuple[str, str, OSError]]:
+        for q in self.queues:
+            q.join()
+        errors = self.errors
+        self.errors = []
+        for [path, ref, error] in errors:
+            if not isinstance(error, OSError):
+                raise error
+        return errors
+
+    def stop(self):
+        for q in self.queues:
+            q.put(None)
+
+
+# Queue that writes are made through, while files are being written in the background
+write_queue: WriteQueue | None = None
+
+def start_writes(threads: int = WRITE_THREADS):
+    global write_queue
+    made_dirs.clear()
+    write_queue = WriteQueue(threads)
+
+# Waits for every queued write to finish, returning the ones that failed
+def drain_writes() -> list[tuple[str, str, OSError]]:
+    return write_queue.drain() if write_queue else []
+
+# Stops writing in the background once every queued write has finished, returning the ones that failed
+def finish_writes() -> list[tuple[str, str, OSError]]:
+    global write_queue
+    if not write_queue:
+        return []
+    try:
+        return write_queue.drain()
+    finally:
+        write_queue.stop()
+        write_queue = None
+
+
+# How much rendered text an `OutputFile` holds before writing it out
+BUFFER_SIZE = 1 << 16
+
+# An output file that is written in chunks as it is rendered. Chunks are collected and written
+# out in batches, with `transform` applied to each batch. With `skip_blank`, the file is only
+# created once something other than whitespace has been written to it.
+class OutputFile:
+    path: str
+    created: bool
+
+    def __init__(self, path: str, transform = None, skip_blank: bool = False, ref: str = None, minifier = None, spans_lines: bool = False):
+        self.path = os.path.normpath(path)
+        # Applied to whole lines at a time, so that it sees every match (unless it can match across lines, when
+        # `spans_lines` holds the whole file until it's closed)
+        self.transform = transform
+        self.spans_lines = spans_lines
+        self.skip_blank = skip_blank
+        self.ref = ref
+        # Strips the text as it's written, after the transform (see `tmcf.minify.Minifier`)
+        self.minifier = minifier
+        self.created = False
+        self.buffer: list[str] = []
+        self.size = 0
+        self.file = None
+
+    def write(self, chunk: str):
+        self.buffer.append(chunk)
+        self.size += len(chunk)
+        if self.size >= BUFFER_SIZE and not self.spans_lines:
+            self.flush()
+
+    def flush(self, force: bool = False):
+        text = "".join(self.buffer)
+        rest = ""
+        if self.transform and not force and not text.endswith("\n"):
+            cut = text.rfind("\n") + 1
+            text, rest = text[:cut], text[cut:]
+            if not text:
+                self.buffer = [rest]
+                self.size = 0
+                return
+        if not self.file:
+            if self.skip_blank and not text.strip():
+                self.buffer = [text + rest]
+                self.size = 0
+                return
+            if not (text or force):
+                return
+            with profile.timer("write"):
+                if discard_writes:
+                    self.file = DiscardedFile()
+                elif archive := archive_for(self.path):
+                    self.file = archive.entry(self.path)
+                elif write_queue:
+                    self.file = QueuedFile(self.path, self.ref)
+                else:
+                    make_dirs(os.path.dirname(self.path))
+                    self.file = open(project_path(self.path), "w", encoding="utf-8")
+            self.created = True
+
+        if self.transform:
+            text = self.transform(text)
+        if self.minifier:
+            text = self.minifier.feed(text)
+        if profile.active:
+            profile.add("bytes", len(text))
+        with profile.timer("write"):
+            self.file.write(text)
+        # The rest of an unfinished line waits for the next flush
+        self.buffer = [rest] if rest else []
+        self.size = 0
+
+    def close(self):
+        self.flush(force=not self.skip_blank)
+        if self.file:
+            if self.minifier and (rest := self.minifier.finish()):
+                self.file.write(rest)
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type:
+            if self.file:
+                self.file.close()
+        else:
+            self.close()
+
+
+# A file written in chunks through the write queue. The file is opened, written and closed by the thread
+# writing it, and if it fails, the rest of its chunks are skipped.
+class QueuedFile:
+    def __init__(self, path: str, ref: str = None):
+        self.path = path
+        self.ref = ref
+        self.file = None
+        self.failed = False
+
+    def write(self, text: str):
+        write_queue.put(self.path, self.ref, self.write_chunk, text)
+
+    def close(self):
+        write_queue.put(self.path, self.ref, self.close_file)
+
+    def write_chunk(self, text: str):
+        if self.failed:
+            return
+        try:
+            if not self.file:
+                make_dirs(os.path.dirname(self.path))
+                self.file = open(project_path(self.path), "w", encoding="utf-8")
+            self.file.write(text)
+        except Exception:
+            self.failed = True
+            self.close_file()
+            raise
+
+    def close_file(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+# Timestamp given to every entry in an archive, so that building the same pack gives the same archive
+ZIP_EPOCH = (1980, 1, 1, 0, 0, 0)
+# Files that are already compressed, which are stored in archives as they are
+COMPRESSED_FORMATS = {".png", ".ogg", ".nbt"}
+
+# A zip archive that a pack is built into instead of a folder. Each file written under `root` is streamed into
+# it as it's written rather than held until the end, in the order the build writes them (source by source) and
+# with fixed timestamps, so the same pack always gives the same archive. A file that's written again replaces the
+# earlier one, which is left out of the archive's directory (so readers only see the last one) but stays in it
+# as unused bytes.
+class Archive:
+    root: str
+    path: str
+    compression_level: int
+    zip: zipfile.ZipFile | None
+    # Whether an entry is being streamed in. The zip only takes one at a time, so anything written meanwhile
+    # waits in `pending` (as a function adding it) until it's done
+    writing: bool
+    pending: list
+
+    def __init__(self, root: str, path: str, compression_level: int = 6):
+        self.root = os.path.normpath(root)
+        self.path = path
+        self.compression_level = compression_level
+        self.zip = None
+        self.writing = False
+        self.pending = []
+
+    def contains(self, path: str) -> bool:
+        return path.startswith(self.root + os.sep)
+
+    def add(self, path: str, contents: str):
+        if self.writing:
+            return self.pending.append(lambda: self.add(path, contents))
+        self.open_zip().writestr(self.info(path), contents.encode(), compresslevel=self.compression_level)
+
+    # Streams a copied file in, deleting it afterwards if `remove` (for files spooled by build workers)
+    def add_file(self, path: str, source: str, remove: bool = False):
+        if self.writing:
+            return self.pending.append(lambda: self.add_file(path, source, remove))
+        # Compressing these again only costs time, so they're stored as they are
+        info = self.info(path, os.path.splitext(path)[1] in COMPRESSED_FORMATS)
+        source = project_path(source)
+        info.file_size = os.path.getsize(source)
+        with open(source, "rb") as src, self.open_zip().open(info, "w") as dst:
+            shutil.copyfileobj(src, dst, BUFFER_SIZE)
+        if remove:
+            os.remove(source)
+
+    # Opens a text file to be streamed in as it's written
+    def entry(self, path: str) -> "ArchiveEntry":
+        if self.writing:
+            return ArchiveEntry(self, path, None)
+        self.writing = True
+        return ArchiveEntry(self, path, self.open_zip().open(self.info(path), "w"))
+
+    # Called when a streamed entry is closed, adding what was written meanwhile
+    def finish_entry(self):
+        self.writing = False
+        while self.pending and not self.writing:
+            self.pending.pop(0)()
+
+    def open_zip(self) -> zipfile.ZipFile:
+        if self.zip is None:
+            os.makedirs(os.path.dirname(os.path.abspath(project_path(self.path))), exist_ok=True)
+            self.zip = zipfile.ZipFile(project_path(self.path), "w", zipfile.ZIP_DEFLATED, compresslevel=self.compression_level)
+        return self.zip
+
+    def info(self, path: str, stored: bool = False) -> zipfile.ZipInfo:
+        name = os.path.relpath(path, self.root).replace(os.sep, "/")
+        archive = self.open_zip()
+        if name in archive.NameToInfo:
+            archive.filelist.remove(archive.NameToInfo.pop(name))
+        info = zipfile.ZipInfo(name, ZIP_EPOCH)
+        info.create_system = 3
+        info.external_attr = 0o644 << 16
+        info.compress_type = zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED
+        # Used by `ZipFile.open`, which otherwise compresses at the default level
+        info._compresslevel = self.compression_level
+        return info
+
+    # Writes the archive's directory, finishing it (if anything was written into it)
+    def close(self):
+        if self.zip is not None:
+            self.zip.close()
+
+    # Throws away a partly written archive, when the build fails
+    def abort(self):
+        if self.zip is None:
+            return
+        try:
+            self.zip.close()
+        except ValueError:
+            # An entry was left open
+            pass
+        self.zip = None
+        os.remove(project_path(self.path))
+
+
+# A text file being streamed into an archive. One written while another is being streamed in is held in a
+# temporary file instead, and added once that's done.
+class ArchiveEntry:
+    def __init__(self, archive: Archive, path: str, file):
+        self.archive = archive
+        self.path = path
+        self.file = file
+        self.spool = None if file else tempfile.NamedTemporaryFile(delete=False)
+
+    def write(self, text: str):
+        (self.file or self.spool).write(text.encode())
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+            self.archive.finish_entry()
+        elif self.spool and not self.spool.closed:
+            self.spool.close()
+            self.archive.add_file(self.path, self.spool.name, remove=True)
+
+
+# Stands in for an archive in build workers, which can't write into the main process's zips. Each file is
+# written to a temporary file in `folder`, and they're handed back (in the order they were written) for the
+# main process to stream in.
+class SpooledArchive:
+    root: str
+    folder: str
+    # The path and temporary file of every file written, in order
+    entries: list[tuple[str, str]]
+
+    def __init__(self, root: str, folder: str):
+        self.root = os.path.normpath(root)
+        self.folder = folder
+        self.entries = []
+
+    def contains(self, path: str) -> bool:
+        return path.startswith(self.root + os.sep)
+
+    def add(self, path: str, contents: str):
+        with self.entry(path) as f:
+            f.write(contents)
+
+    def add_file(self, path: str, source: str):
+        shutil.copyfile(project_path(source), self.spool(path))
+
+    def entry(self, path: str):
+        return open(self.spool(path), "w", encoding="utf-8", newline="")
+
+    def spool(self, path: str) -> str:
+        descriptor, spooled = tempfile.mkstemp(dir=self.folder)
+        os.close(descriptor)
+        self.entries.append((path, spooled))
+        return spooled
+
+    # Removes and returns the files written so far
+    def take(self) -> list[tuple[str, str]]:
+        entries = self.entries
+        self.entries = []
+        return entries
+
+# A file that is thrown away as it's written (see `discard_writes`)
+class DiscardedFile:
+    def write(self, text: str):
+        pass
+
+    def close(self):
+        pass
+
+# The archives that the packs are being built into, when building into zips
+archives: list[Archive | SpooledArchive] = []
+
+# Returns the archive that a path in the build is written into, if any
+def archive_for(path: str) -> Archive | SpooledArchive | None:
+    for archive in archives:
+        if archive.contains(path):
+            return archive
+    return None
+
+
+# Deletes a file, along with any directories up to (but not including) `root` that it leaves empty
+def remove(path: str, root: str) -> bool:
+    path = project_path(path)
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        return False
+
+    root = os.path.abspath(project_path(root))
+    directory = os.path.dirname(os.path.abspath(path))
+    while directory.startswith(root + os.sep):
+        try:
+            os.rmdir(directory)
+        except OSError:
+            break
+        made_dirs.clear()
+        directory = os.path.dirname(directory)
+    return True
+
+
+# Copies a file without passing its contents through Python where possible: as a hard link when both
+# paths are on the same filesystem, otherwise by having the kernel copy the data, falling back to a
+# buffered copy. The copy keeps the source's modification time, so it can be recognised as up to date later.
+def copy_file(source: str, destination: str):
+    destination = os.path.normpath(destination)
+    if archive := archive_for(destination):
+        return archive.add_file(destination, source)
+    make_dirs(os.path.dirname(destination))
+    source = project_path(source)
+    destination = project_path(destination)
+    if os.path.lexists(destination):
+        os.remove(destination)
+
+    try:
+        os.link(source, destination)
+        return
+    except (OSError, AttributeError, NotImplementedError):
+        pass
+
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        stat = os.fstat(src.fileno())
+        if not kernel_copy(src.fileno(), dst.fileno(), stat.st_size):
+            shutil.copyfileobj(src, dst, BUFFER_SIZE)
+    os.utime(destination, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+# Copies `size` bytes between two files with `copy_file_range` or `sendfile`, returning False
+# if neither is supported here (so nothing was copied)
+def kernel_copy(source: int, destination: int, size: int) -> bool:
+    methods = []
+    if hasattr(os, "copy_file_range"):
+        methods.append(lambda offset: os.copy_file_range(source, destination, size - offset, offset, offset))
+    if hasattr(os, "sendfile"):
+        methods.append(lambda offset: os.sendfile(destination, source, offset, size - offset))
+
+    for method in methods:
+        offset = 0
+        try:
+            while offset < size:
+                copied = method(offset)
+                if copied == 0:
+                    break
+                offset += copied
+        except OSError:
+            # Unsupported filesystems fail straight away, anything later is a real error
+            if offset:
+                raise
+            continue
+        # Some filesystems (like FUSE and network mounts) copy nothing rather than failing. Like `shutil`, that's
+        # taken to mean the method isn't supported, rather than leaving the copy empty.
+        if offset or not size:
+            return True
+    return False
+
+# Returns whether `destination` has the same size and modification time as a source file's `stat`
+def is_copy_current(stat: os.stat_result, destination: str) -> bool:
+    try:
+        copied = os.stat(project_path(destination))
+    except OSError:
+        return False
+    return copied.st_size == stat.st_size and copied.st_mtime_ns == stat.st_mtime_ns
+
+
+# Returns the sha256 hex digest of a file's contents
+def hash_file(path: str) -> str:
+    with open(project_path(path), "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
 # A wrapper for a list of strings allowing them to be read one-by-one and passed around
 class Consumable:
     strings: list[str]
@@ -28,3 +553,23 @@ class Consumable:
     # Returns whether there is still more to read or not
     def is_consumable(self) -> bool:
         return self.index < len(self.strings)
+
+
+# The items of a for loop, made one at a time as the loop reaches them rather than held in a list,
+# so that a loop (and every loop nested in it) only ever holds the item it's on
+class LoopItems:
+    values: Iterable
+    # Whether each item is its position and value (`enum`), rather than just the value
+    enumerated: bool
+
+    def __init__(self, values: Iterable, enumerated: bool = False):
+        self.values = values
+        self.enumerated = enumerated
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def __iter__(self) -> Iterator[tuple]:
+        if self.enumerated:
+            return enumerate(self.values)
+        return ((value,) for value in self.values)
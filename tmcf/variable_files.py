@@ -0,0 +1,140 @@
+import codecs
+import csv
+import hashlib
+import json
+import mmap
+import os
+import re
+from contextlib import contextmanager
+from urllib.parse import quote
+
+from tmcf import profile
+from tmcf.logging import l
+from tmcf.utils import project_path
+
+# Bump whenever the way files are parsed changes, so stale caches are thrown away instead of loaded (and the files
+# using them are rebuilt)
+CACHE_VERSION = 2
+CACHE_DIR = "./.tmcf/variables"
+FORMATS = [".json", ".csv", ".txt"]
+# Csv and txt files at least this big are memory-mapped rather than read into memory before parsing (json is
+# always read, as it's parsed all at once)
+MMAP_MIN = 1 << 20
+
+NUMBER = re.compile(r"-?\d+")
+DECIMAL = re.compile(r"-?\d+\.\d+")
+
+# Variables loaded from files so far this build, by name
+loaded: dict[str, object] = {}
+
+
+# Returns the value of a variable from `[variable_files]`, loading it the first time it's used in this build.
+# Parsed values are cached in the project's `.tmcf` folder by the file's hash, so a file is only parsed again once it changes.
+def load(name: str, source: dict, ref: str = None):
+    if name in loaded:
+        return loaded[name]
+
+    with profile.timer("parse"):
+        try:
+            with open_data(source["path"]) as data:
+                digest = source_hash(source, data)
+                value = load_cache(name, digest)
+                if value is None:
+                    value = parse(name, source, data, ref)
+                    save_cache(name, digest, value)
+        except OSError as e:
+            l.fatal(f"Failed to read variable '{name}' from '{source['path']}': {e.strerror or e}", ref)
+    loaded[name] = value
+    return value
+
+
+# Returns a key for a variable file and how it's read, which changes whenever the variable's value could. Like copied
+# files (see `utils.is_copy_current`) it goes by the file's size and modification time, so that telling whether it
+# changed doesn't mean reading it; the file is only hashed once it's loaded, to find its cached value.
+def source_stamp(source: dict) -> str:
+    stat = os.stat(project_path(source["path"]))
+    return f"{CACHE_VERSION}:{os.path.splitext(source['path'])[1]}:{source['header']}:{stat.st_size}:{stat.st_mtime_ns}"
+
+# Returns a hash of a variable file and how it's read, for its cached value
+def source_hash(source: dict, data) -> str:
+    digest = hashlib.sha256(f"{CACHE_VERSION}:{os.path.splitext(source['path'])[1]}:{source['header']}:".encode())
+    digest.update(data)
+    return digest.hexdigest()
+
+
+# Opens a file's contents as bytes, memory-mapped if it's big so that it's only paged in as it's parsed
+@contextmanager
+def open_data(path: str):
+    with open(project_path(path), "rb") as f:
+        if os.fstat(f.fileno()).st_size < MMAP_MIN or os.path.splitext(path)[1] == ".json":
+            yield f.read()
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield data
+
+
+def parse(name: str, source: dict, data, ref: str):
+    path = source["path"]
+    extension = os.path.splitext(path)[1]
+    try:
+        if extension == ".json":
+            value = json.loads(data)
+        else:
+            lines = codecs.iterdecode(iter(data.readline, b"") if isinstance(data, mmap.mmap) else data.splitlines(keepends=True), "utf-8")
+            value = parse_csv(lines, source["header"]) if extension == ".csv" else parse_txt(lines)
+    except (ValueError, csv.Error) as e:
+        l.fatal(f"Failed to parse variable '{name}' from '{path}': {e}", ref)
+
+    # The same rules as variables in `tmcf.toml`
+    if isinstance(value, dict) or value is None:
+        l.fatal(f"Variable '{name}' in '{path}' must be a list, number, or string", ref)
+    return value
+
+# Each row is a list of values, or a single value if every row only has one
+def parse_csv(lines, header: bool) -> list:
+    rows = [[parse_value(cell) for cell in row] for row in csv.reader(lines) if row]
+    if header:
+        rows = rows[1:]
+    if all(len(row) == 1 for row in rows):
+        return [row[0] for row in rows]
+    return rows
+
+# Each line that isn't blank is a value
+def parse_txt(lines) -> list:
+    return [parse_value(line) for line in (line.rstrip("\r\n") for line in lines) if line.strip()]
+
+# Values that are numbers become numbers, like they would be in `tmcf.toml`, unless that would change how
+# they're written (like `007` or `1.50`), as they're put back into files as text
+def parse_value(s: str):
+    if NUMBER.fullmatch(s) and str(int(s)) == s:
+        return int(s)
+    if DECIMAL.fullmatch(s) and str(float(s)) == s:
+        return float(s)
+    return s
+
+
+def cache_path(name: str, digest: str) -> str:
+    return os.path.join(CACHE_DIR, f"{quote(name, safe='')}-{digest}.json")
+
+# Cached values are json (values are only ever lists, numbers and strings), so a cache that was tampered with can
+# at worst give a wrong value, never run anything
+def load_cache(name: str, digest: str):
+    try:
+        with open(project_path(cache_path(name, digest)), "rb") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(cache, dict) or cache.get("version") != CACHE_VERSION or isinstance(cache.get("value"), dict):
+        return None
+    return cache["value"]
+
+# Saves a parsed variable, replacing its cache from older versions of the file
+def save_cache(name: str, digest: str, value):
+    folder = project_path(CACHE_DIR)
+    os.makedirs(folder, exist_ok=True)
+    path = project_path(cache_path(name, digest))
+    for entry in os.listdir(folder):
+        if entry.rsplit("-", 1)[0] == quote(name, safe="") and entry != os.path.basename(path):
+            os.remove(os.path.join(folder, entry))
+    with open(path, "w") as f:
+        json.dump({"version": CACHE_VERSION, "value": value}, f, separators=(",", ":"))